@@ -3,6 +3,7 @@ from gevent import monkey; monkey.patch_all()
 
 import bottle
 import click
+import functools
 import gevent
 import logging
 import pymysql
@@ -10,12 +11,18 @@ import shh
 import sys
 import time
 
-from DBUtils.PooledDB import PooledDB
 from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
 from pymysql import Connection
 
 from utils import log_exceptions, nice_shutdown
-from utils.logging import configure_logging, wsgi_log_middleware
+from utils.admission import admission_control_middleware
+from utils.compression import gzip_middleware
+from utils.logging import RequestLogSampler, configure_logging, parse_sample_rule
+from utils.logging import wsgi_log_middleware
+from utils.metrics import REGISTRY, Gauge, snapshot_path, wsgi_metrics_middleware
+from utils.pool import ConnectionPool
+from utils.prefork import run_prefork
 
 from shh import construct_app, run_worker
 from shh.dao import ShhDao, create_db
@@ -37,6 +44,25 @@ def main():
     pass
 
 
+def parse_sample_rules(ctx, param, value):
+    try:
+        return [parse_sample_rule(rule) for rule in value]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def construct_connection_pool(options, **pool_options):
+    connect = functools.partial(Connection,
+                                host=options['mysql_host'],
+                                port=options['mysql_port'],
+                                user=options['mysql_user'],
+                                password=options['mysql_password'],
+                                database=options['mysql_database'],
+                                charset='utf8mb4',
+                                cursorclass=pymysql.cursors.DictCursor)
+    return ConnectionPool(connect, **pool_options)
+
+
 @click.command()
 @click.option('--mysql-host', default='localhost',
               help='MySQL server host. (default=localhost)')
@@ -66,20 +92,7 @@ def init(**options):
 
     create_db(connection, options['mysql_database'])
 
-    connection_pool = PooledDB(creator=pymysql,
-                               mincached=1,
-                               maxcached=10,
-                               # max connections currently in use - doesn't
-                               # include cached connections
-                               maxconnections=50,
-                               blocking=True,
-                               host=options['mysql_host'],
-                               port=options['mysql_port'],
-                               user=options['mysql_user'],
-                               password=options['mysql_password'],
-                               database=options['mysql_database'],
-                               charset='utf8mb4',
-                               cursorclass=pymysql.cursors.DictCursor)
+    connection_pool = construct_connection_pool(options, min_size=1, max_size=1, max_idle=1)
     shh_dao = ShhDao(connection_pool)
 
     shh_dao.create_secret_table()
@@ -109,6 +122,28 @@ def init(**options):
 @click.option('--oidc-public-key-file', default='id_rsa.pub', type=click.File(mode='rb'),
               help='Path to RSA256 public key file for the OpenID Connect provider. '
                    '(default=id_rsa.pub)')
+@click.option('--oidc-public-key-dir', type=click.Path(exists=True, file_okay=False),
+              help='Path to a directory of RSA256 public key files for the OpenID Connect '
+                   'provider, named <key ID>.pub. Tokens are verified with the key matching their '
+                   'key ID, falling back to --oidc-public-key-file. New files are picked up '
+                   'without a restart.')
+@click.option('--oidc-pool-size', default=10,
+              help='Maximum number of keep-alive connections to the OpenID Connect provider. '
+                   '(default=10)')
+@click.option('--oidc-timeout', default=10.0,
+              help='Timeout in seconds for requests to the OpenID Connect provider. (default=10)')
+@click.option('--oidc-retries', default=2,
+              help='How many times to retry failed connections to the OpenID Connect provider. '
+                   '(default=2)')
+@click.option('--oidc-retry-backoff', default=0.5,
+              help='Backoff factor in seconds between connection retries to the OpenID Connect '
+                   'provider. (default=0.5)')
+@click.option('--oidc-breaker-threshold', default=5,
+              help='Number of consecutive failed requests to the OpenID Connect provider before '
+                   'failing fast. (default=5)')
+@click.option('--oidc-breaker-reset', default=30.0,
+              help='How many seconds to fail fast for before trying the OpenID Connect provider '
+                   'again. (default=30)')
 @click.option('--oidc-client-id', required=True,
               help='Client ID issued by the OpenID Connect provider.')
 @click.option('--oidc-client-secret', required=True,
@@ -123,10 +158,57 @@ def init(**options):
               help='MySQL server password. (default=None)')
 @click.option('--mysql-database', default='shh',
               help='MySQL server database. (default=shh)')
+@click.option('--mysql-pool-min', default=1,
+              help='Number of MySQL connections to open on startup, per worker process. (default=1)')
+@click.option('--mysql-pool-max', default=50,
+              help='Maximum number of open MySQL connections, per worker process. (default=50)')
+@click.option('--mysql-pool-idle', default=10,
+              help='Maximum number of idle MySQL connections to keep open, per worker process. '
+                   '(default=10)')
+@click.option('--mysql-pool-timeout', default=5.0,
+              help='Maximum time in seconds a request waits for a MySQL connection before being '
+                   'rejected with a 503. (default=5)')
+@click.option('--mysql-pool-recycle', default=3600.0,
+              help='Replace MySQL connections older than this many seconds. 0 to disable. '
+                   '(default=3600)')
+@click.option('--mysql-pool-ping-idle', default=30.0,
+              help='Ping MySQL connections idle for at least this many seconds before reusing '
+                   'them. (default=30)')
+@click.option('--session-cache-size', default=10000,
+              help='Maximum number of verified sessions to cache, to avoid verifying the session '
+                   'token of every request. 0 disables the cache. (default=10000)')
 @click.option('--testing-mode', default=False, is_flag=True,
               help='Relax security to simplify testing, e.g. allow http cookies')
 @click.option('--port', '-p', default=8080,
               help='Port to serve on. (default=8080)')
+@click.option('--workers', default=1,
+              help='Number of server processes to run. Each process serves requests with its own '
+                   'gevent loop and database connection pool. (default=1)')
+@click.option('--max-concurrency', default=50,
+              help='Maximum number of requests handled concurrently, per worker process. Should be '
+                   'no more than --mysql-pool-max. (default=50)')
+@click.option('--max-queue', default=100,
+              help='Maximum number of requests waiting to be handled, per worker process. Requests '
+                   'beyond this are rejected with a 503. (default=100)')
+@click.option('--queue-timeout', default=5.0,
+              help='Maximum time in seconds a request waits to be handled before being rejected '
+                   'with a 503. (default=5)')
+@click.option('--retry-after', default=1,
+              help='Seconds clients are told to wait before retrying rejected requests. '
+                   '(default=1)')
+@click.option('--compress-level', default=6, type=click.IntRange(0, 9),
+              help='gzip compression level for responses. 0 to disable compression. (default=6)')
+@click.option('--compress-min-size', default=1024,
+              help='Only compress responses of at least this many bytes. (default=1024)')
+@click.option('--metrics-dir', type=click.Path(exists=True, file_okay=False, writable=True),
+              help='Path of a directory that server and worker processes write metrics snapshots '
+                   'to. /-/metrics combines the metrics of all the processes writing to it. '
+                   'Required to see all metrics when running multiple workers. Snapshots of exited '
+                   'processes are folded into one file, so should be on a local filesystem that '
+                   'supports file locks.')
+@click.option('--metrics-interval', default=5.0,
+              help='How many seconds between writing metrics snapshots to --metrics-dir. '
+                   '(default=5)')
 @click.option('--shutdown-sleep', default=10,
               help='How many seconds to sleep during graceful shutdown. (default=10)')
 @click.option('--shutdown-wait', default=10,
@@ -136,6 +218,27 @@ def init(**options):
               help='Log in json.')
 @click.option('--verbose', '-v', default=False, is_flag=True,
               help='Log debug messages.')
+@click.option('--async-logging', default=False, is_flag=True,
+              help='Format and write logs in a background thread, so slow log collection doesn\'t '
+                   'block request handling.')
+@click.option('--log-queue-size', default=10000,
+              help='Maximum number of log records waiting to be written, with --async-logging. '
+                   '(default=10000)')
+@click.option('--log-overflow', type=click.Choice(('drop', 'block')), default='drop',
+              help='What to do with log records when the log queue is full, with --async-logging. '
+                   '"drop" discards them, "block" waits for space. (default=drop)')
+@click.option('--log-sample', type=str, multiple=True, callback=parse_sample_rules,
+              default=('/-/*=0.01', '/*.css=0.01', '/robots.txt=0.01',
+                       '/site.webmanifest=0.01', '/favicon.ico=0.01', '/*.png=0.01', '/*.js=0.01'),
+              help='Log only a fraction of successful requests to matching paths, e.g. '
+                   '"/-/*=0.01" logs 1% of health check requests. Can be given multiple times - '
+                   'the first matching rule applies. Unsuccessful and slow requests are always '
+                   'logged. (default=health checks and static files at 1%)')
+@click.option('--log-slow-ms', default=1000,
+              help='Always log requests that take at least this many milliseconds. (default=1000)')
+@click.option('--log-rate-limit', default=0,
+              help='Maximum number of requests to log per second, per worker process. 0 for no '
+                   'limit. (default=0)')
 @log_exceptions(exit_on_exception=True)
 def server(**options):
 
@@ -159,37 +262,80 @@ def server(**options):
         # Run in greenlet, as we can't block in a signal hander.
         gevent.spawn(wait)
 
-    configure_logging(json=options['json'], verbose=options['verbose'])
-
-    connection_pool = PooledDB(creator=pymysql,
-                               mincached=1,
-                               maxcached=10,
-                               # max connections currently in use - doesn't
-                               # include cached connections
-                               maxconnections=50,
-                               blocking=True,
-                               host=options['mysql_host'],
-                               port=options['mysql_port'],
-                               user=options['mysql_user'],
-                               password=options['mysql_password'],
-                               database=options['mysql_database'],
-                               charset='utf8mb4',
-                               cursorclass=pymysql.cursors.DictCursor)
-    shh_dao = ShhDao(connection_pool)
+    def write_metrics_snapshots():
+        path = snapshot_path(options['metrics_dir'], 'server')
+        while True:
+            try:
+                REGISTRY.write_snapshot(path, stale_after=3 * options['metrics_interval'])
+            except Exception:
+                log.exception('Failed to write metrics snapshot.')
+            time.sleep(options['metrics_interval'])
+
+    def serve(listener=None):
+        Gauge('shh_server_greenlets', 'Number of greenlets handling connections.') \
+            .set_function(lambda: len(gevent_pool))
+        if options['metrics_dir']:
+            gevent.spawn(write_metrics_snapshots)
+
+        connection_pool = construct_connection_pool(options,
+                                                    min_size=options['mysql_pool_min'],
+                                                    max_size=options['mysql_pool_max'],
+                                                    max_idle=options['mysql_pool_idle'],
+                                                    acquire_timeout=options['mysql_pool_timeout'],
+                                                    recycle=options['mysql_pool_recycle'] or None,
+                                                    ping_idle=options['mysql_pool_ping_idle'])
+        shh_dao = ShhDao(connection_pool)
+
+        token_decoder = TokenDecoder(public_key, options['oidc_iss'], options['oidc_client_id'],
+                                     oidc_public_key_dir=options['oidc_public_key_dir'])
+
+        app = construct_app(shh_dao, token_decoder, **options)
+        if options['compress_level']:
+            app = gzip_middleware(app,
+                                  min_size=options['compress_min_size'],
+                                  level=options['compress_level'])
+        app = admission_control_middleware(app,
+                                           max_concurrency=options['max_concurrency'],
+                                           max_queue=options['max_queue'],
+                                           queue_timeout=options['queue_timeout'],
+                                           retry_after=options['retry_after'])
+        app = wsgi_metrics_middleware(app)
+        request_logger = logging.getLogger('wsgi_request')
+        sampler = RequestLogSampler(request_logger,
+                                    rules=options['log_sample'],
+                                    slow_ms=options['log_slow_ms'],
+                                    rate_limit=options['log_rate_limit'])
+        app = wsgi_log_middleware(app, request_logger=request_logger, sampler=sampler)
+
+        with nice_shutdown(shutdown):
+            if listener is None:
+                bottle.run(app,
+                           host='0.0.0.0', port=options['port'],
+                           server='gevent', spawn=gevent_pool,
+                           # Disable default request logging - we're using middleware
+                           quiet=True, error_log=None)
+            else:
+                WSGIServer(listener, app, spawn=gevent_pool,
+                           # Disable default request logging - we're using middleware
+                           log=None, error_log=None).serve_forever()
+
+    configure_logging(json=options['json'], verbose=options['verbose'],
+                      async_logging=options['async_logging'],
+                      log_queue_size=options['log_queue_size'],
+                      log_overflow=options['log_overflow'])
 
     with options['oidc_public_key_file'] as file:
         public_key = file.read()
-    token_decoder = TokenDecoder(public_key, options['oidc_iss'], options['oidc_client_id'])
 
-    app = construct_app(shh_dao, token_decoder, **options)
-    app = wsgi_log_middleware(app)
+    if options['workers'] > 1:
+        if not options['metrics_dir']:
+            log.warning('Running multiple workers without --metrics-dir. /-/metrics will only '
+                        'include the metrics of the worker that handles the request.')
 
-    with nice_shutdown(shutdown):
-        bottle.run(app,
-                   host='0.0.0.0', port=options['port'],
-                   server='gevent', spawn=gevent_pool,
-                   # Disable default request logging - we're using middleware
-                   quiet=True, error_log=None)
+        # Each worker process gets its own DB connection pool etc., as `serve` is run after forking.
+        run_prefork(serve, options['workers'], '0.0.0.0', options['port'])
+    else:
+        serve()
 
 
 @click.command()
@@ -203,6 +349,33 @@ def server(**options):
               help='MySQL server password. (default=None)')
 @click.option('--mysql-database', default='shh',
               help='MySQL server database. (default=shh)')
+@click.option('--delete-chunk-size', default=1000,
+              help='Maximum number of expired secrets to delete in each transaction. '
+                   '(default=1000)')
+@click.option('--delete-chunk-pause', default=0.1,
+              help='How many seconds to pause between deletion transactions. (default=0.1)')
+@click.option('--delete-max-chunks', default=100,
+              help='Maximum number of deletion transactions to run each time the worker runs. '
+                   '(default=100)')
+@click.option('--min-sleep', default=1.0,
+              help='Minimum number of seconds to sleep between worker runs. (default=1)')
+@click.option('--max-sleep', default=60.0,
+              help='Maximum number of seconds to sleep between worker runs. (default=60)')
+@click.option('--expiry-batch-window', default=5.0,
+              help='How many seconds after the next secret expiry to wait before deleting, so '
+                   'secrets that expire close together are deleted in one run. (default=5)')
+@click.option('--worker-lock-name',
+              help='Name of the MySQL advisory lock used to elect the active worker, when running '
+                   'multiple workers. (default=<mysql-database>.worker)')
+@click.option('--standby-sleep', default=10.0,
+              help='How many seconds standby workers sleep between attempts to become the active '
+                   'worker. (default=10)')
+@click.option('--metrics-file',
+              help='Path of a file to write worker metrics to after each run, in the Prometheus '
+                   'text format.')
+@click.option('--metrics-dir', type=click.Path(exists=True, file_okay=False, writable=True),
+              help='Path of a directory to write worker metrics snapshots to after each run, so '
+                   'the server\'s /-/metrics includes them. Should be the server\'s --metrics-dir.')
 @click.option('--json', '-j', default=False, is_flag=True,
               help='Log in json.')
 @click.option('--verbose', '-v', default=False, is_flag=True,
@@ -212,22 +385,17 @@ def worker(**options):
 
     configure_logging(json=options['json'], verbose=options['verbose'])
 
-    connection_pool = PooledDB(creator=pymysql,
-                               mincached=1,
-                               maxcached=1,
-                               # max connections currently in use - doesn't
-                               # include cached connections
-                               maxconnections=1,
-                               blocking=True,
-                               host=options['mysql_host'],
-                               port=options['mysql_port'],
-                               user=options['mysql_user'],
-                               password=options['mysql_password'],
-                               database=options['mysql_database'],
-                               charset='utf8mb4',
-                               cursorclass=pymysql.cursors.DictCursor)
+    # The worker's advisory lock belongs to its MySQL session, so it needs a single connection that
+    # isn't recycled - see ShhDao.acquire_lock().
+    connection_pool = construct_connection_pool(options, min_size=1, max_size=1, max_idle=1,
+                                                recycle=None)
     shh_dao = ShhDao(connection_pool)
 
+    # Advisory locks are server wide, so include the database in the name by default, in case the
+    # server hosts multiple shh databases.
+    if not options['worker_lock_name']:
+        options['worker_lock_name'] = f'{options["mysql_database"]}.worker'
+
     with nice_shutdown():
         run_worker(shh_dao, **options)
 
@@ -1,17 +1,22 @@
+import json
 import logging
-import requests
 import rfc3339
 import time
 
-from bottle import Bottle, request, response, static_file, template, redirect
+from bottle import Bottle, HTTPError, SimpleTemplate, request, response, redirect
 from datetime import timedelta
 from jwt.exceptions import InvalidTokenError
 from urllib.parse import urlparse, urljoin, urlencode
 
-from utils.param_parse import parse_params, string_param
+from utils.http import CircuitBreaker, CircuitOpenError, construct_session
+from utils.metrics import REGISTRY, Counter, Gauge, Histogram, snapshot_path
+from utils.param_parse import ParamParseError, parse_params, string_param
+from utils.pool import PoolTimeoutPlugin
+from utils.static_assets import StaticAssets
 
 from .dao import Secret
 from .misc import abort, html_default_error_hander, generate_id, hash_urlsafe, security_headers
+from .misc import encode_page_cursor, json_error, page_cursor_param, render_cache, template
 from .session import SessionHandler
 
 
@@ -19,6 +24,8 @@ log = logging.getLogger(__name__)
 
 
 DEFAULT_CONTINUE_URL = '/'
+# Substituted with each login's OIDC request URI in the pre-rendered login page.
+OIDC_LOGIN_URI_PLACEHOLDER = '__oidc_login_uri__'
 
 VALID_TTLS = {
     '1h': (timedelta(hours=1), '1 hour'),
@@ -27,6 +34,16 @@ VALID_TTLS = {
     '5m': (timedelta(minutes=5), '5 minutes'),
 }
 
+# Maximum number of secrets shown on each page of the secrets listing.
+SECRETS_PAGE_SIZE = 100
+
+# Maximum number of secrets that can be created with a single bulk API request.
+MAX_BULK_SECRETS = 500
+# Maximum size of a bulk API request body. Allows for the maximum number of secrets, with maximum
+# length secrets and descriptions, even with every character escaped as a single `\uXXXX`. Bottle's
+# default limit of 100KB is far lower.
+MAX_BULK_BODY_BYTES = MAX_BULK_SECRETS * 16 * 1024
+
 SERVER_READY = True
 
 
@@ -37,13 +54,33 @@ def construct_app(dao, token_decoder,
                   oidc_auth_endpoint, oidc_token_endpoint,
                   oidc_client_id, oidc_client_secret,
                   testing_mode,
+                  session_cache_size=0,
+                  oidc_pool_size=10, oidc_timeout=10,
+                  oidc_retries=2, oidc_retry_backoff=0.5,
+                  oidc_breaker_threshold=5, oidc_breaker_reset=30,
+                  retry_after=1, metrics_dir=None,
                   **kwargs):
 
-    session_handler = SessionHandler(token_decoder, testing_mode=testing_mode)
+    session_handler = SessionHandler(token_decoder, testing_mode=testing_mode,
+                                     session_cache_size=session_cache_size)
+
+    static_assets = StaticAssets('static')
+    # Let templates link to static assets by their content hashed URLs.
+    SimpleTemplate.defaults['asset_url'] = static_assets.url
+
+    # Pre-render pages that don't depend on the session or request.
+    render_cache.render('index', user_id=None, csrf=None)
+    render_cache.render('error_404', message=None)
+    render_cache.render('error', message=None)
+    login_page = render_cache.render_with_placeholder('login',
+                                                      ('oidc_login_uri', OIDC_LOGIN_URI_PLACEHOLDER),
+                                                      oidc_name=oidc_name,
+                                                      oidc_about_url=oidc_about_url)
 
     app = Bottle()
     app.default_error_handler = html_default_error_hander
     app.install(security_headers)
+    app.install(PoolTimeoutPlugin(retry_after=retry_after))
 
     service_address = f'{service_protocol}://{service_hostname}'
     if service_port:
@@ -53,6 +90,17 @@ def construct_app(dao, token_decoder,
 
     oidc_redirect_uri = urljoin(service_address, '/oidc/callback')
 
+    # Share keep-alive connections to the OIDC provider between logins, rather than connecting
+    # (and doing a TLS handshake) for each one. Fail fast while the provider is down, rather than
+    # tying up greenlets waiting on it.
+    oidc_session = construct_session(pool_size=oidc_pool_size,
+                                     retries=oidc_retries,
+                                     backoff_factor=oidc_retry_backoff)
+    oidc_token_breaker = CircuitBreaker('oidc_token_endpoint',
+                                        failure_threshold=oidc_breaker_threshold,
+                                        reset_timeout=oidc_breaker_reset,
+                                        is_failure=lambda r: r.status_code >= 500)
+
     def check_continue_url(continue_url):
         try:
             parsed_continue_url = urlparse(continue_url)
@@ -104,30 +152,36 @@ def construct_app(dao, token_decoder,
             response.status = 503
             return 'Unavailable'
 
+    @app.get('/-/metrics')
+    def metrics():
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        # With multiple processes, each writes snapshots of its metrics to the metrics directory.
+        if metrics_dir:
+            return REGISTRY.render_merged(metrics_dir)
+        else:
+            return REGISTRY.render()
+
     @app.get('/')
     @session_handler.maybe_session()
     def index():
-        if request.session:
-            user_id = request.session['user_id']
-            csrf = request.session['csrf']
-        else:
-            user_id = csrf = None
+        if not request.session:
+            return render_cache.render('index', user_id=None, csrf=None)
 
         return template('index',
-                        user_id=user_id,
-                        csrf=csrf)
+                        user_id=request.session['user_id'],
+                        csrf=request.session['csrf'])
 
-    @app.get('/main.css')
-    def css():
-        return static_file('main.css', root='static')
+    @app.get('/<filename>.css')
+    def css(filename):
+        return static_assets.serve(f'{filename}.css')
 
     @app.get('/robots.txt')
     def robots():
-        return static_file('robots.txt', root='static')
+        return static_assets.serve('robots.txt')
 
     @app.get('/site.webmanifest')
     def manifest():
-        return static_file('site.webmanifest', root='static')
+        return static_assets.serve('site.webmanifest')
 
     # Set CORP to allow Firefox for Android to load icons.
     # Firefox for Android seems to consider the icon loader a different origin.
@@ -137,16 +191,16 @@ def construct_app(dao, token_decoder,
     @app.get('/favicon.ico',
              sh_updates={'Cross-Origin-Resource-Policy': 'cross-origin'})
     def icon():
-        return static_file('favicon.ico', root='static')
+        return static_assets.serve('favicon.ico')
 
     @app.get('/<filename>.png',
              sh_updates={'Cross-Origin-Resource-Policy': 'cross-origin'})
     def root_pngs(filename):
-        return static_file(f'{filename}.png', root='static')
+        return static_assets.serve(f'{filename}.png')
 
     @app.get('/<filename>.js')
     def scripts(filename):
-        return static_file(f'{filename}.js', root='static')
+        return static_assets.serve(f'{filename}.js')
 
     @app.get('/login')
     def get_login():
@@ -161,10 +215,7 @@ def construct_app(dao, token_decoder,
         # NOTE: The state field works as Login CSRF protection.
         session_handler.set_oidc_data(state, nonce, continue_url or DEFAULT_CONTINUE_URL)
 
-        return template('login',
-                        oidc_name=oidc_name,
-                        oidc_about_url=oidc_about_url,
-                        oidc_login_uri=oidc_login_uri)
+        return login_page(oidc_login_uri)
 
     @app.get('/oidc/callback')
     def get_oidc_callback():
@@ -233,12 +284,17 @@ def construct_app(dao, token_decoder,
         #       the user agent.
         check_continue_url(continue_url)
 
-        r = requests.post(oidc_token_endpoint, timeout=10,
-                          auth=(oidc_client_id, oidc_client_secret),
-                          data={'grant_type': 'authorization_code',
-                                'client_id': oidc_client_id,
-                                'redirect_uri': oidc_redirect_uri,
-                                'code': code})
+        try:
+            r = oidc_token_breaker.call(oidc_session.post, oidc_token_endpoint,
+                                        timeout=oidc_timeout,
+                                        auth=(oidc_client_id, oidc_client_secret),
+                                        data={'grant_type': 'authorization_code',
+                                              'client_id': oidc_client_id,
+                                              'redirect_uri': oidc_redirect_uri,
+                                              'code': code})
+        except CircuitOpenError:
+            log.warning('OIDC token endpoint is unavailable. Failing fast.')
+            abort(503)
 
         # Only supported response status code.
         if r.status_code == 200:
@@ -318,21 +374,106 @@ def construct_app(dao, token_decoder,
                         secret_id=secret_id,
                         ttl=VALID_TTLS[ttl][1])
 
+    # Bulk create secrets for machine clients, via JSON.
+    # NOTE: Requests must have a JSON content type, which can't be sent cross-origin without a CORS
+    #       preflight (which we don't allow), so there's no need for CSRF protection here.
+    @app.post('/api/secrets')
+    @session_handler.maybe_session(check_csrf=False, maybe_refresh=False)
+    def submit_secrets():
+        if request.session:
+            user_id = request.session['user_id']
+        else:
+            user_id = None
+
+        # Errors are returned as JSON, identifying the secret at fault where there is one.
+        # The body is parsed here, rather than with `request.json`, to allow for a larger body than
+        # bottle's limit. Only JSON bodies are accepted, as `request.json` would.
+        secret_dicts = None
+        if request.content_type.split(';')[0].strip().lower() == 'application/json':
+            if request.content_length > MAX_BULK_BODY_BYTES:
+                return json_error(413, 'Request entity too large')
+
+            try:
+                body = request.body.read(MAX_BULK_BODY_BYTES + 1)
+            except HTTPError as e:
+                return json_error(e.status_code, e.body)
+            if len(body) > MAX_BULK_BODY_BYTES:
+                return json_error(413, 'Request entity too large')
+
+            try:
+                secret_dicts = json.loads(body)
+            except ValueError:
+                return json_error(400, 'Invalid JSON')
+
+        if not isinstance(secret_dicts, list) or not secret_dicts:
+            return json_error(400, 'Expected a JSON array of secrets.')
+
+        if len(secret_dicts) > MAX_BULK_SECRETS:
+            return json_error(400, f'Can\'t create more than {MAX_BULK_SECRETS} secrets at once.')
+
+        now_dt = rfc3339.now()
+        secrets = []
+        for i, secret_dict in enumerate(secret_dicts):
+            if not isinstance(secret_dict, dict) or \
+                    not all(isinstance(v, str) for v in secret_dict.values()):
+                return json_error(400,
+                                  'Expected each secret to be a JSON object with string values.',
+                                  index=i)
+
+            try:
+                params = parse_params(secret_dict,
+                                      description=string_param('description', strip=True,
+                                                               max_length=100),
+                                      secret=string_param('secret', required=True,
+                                                          max_length=2000),
+                                      ttl=string_param('ttl', required=True,
+                                                       enum=VALID_TTLS.keys()))
+            except ParamParseError as e:
+                return json_error(e.status_code, e.body, index=i)
+
+            secrets.append(Secret(secret_id=generate_id(),
+                                  user_id=user_id,
+                                  description=params.get('description'),
+                                  secret=params['secret'],
+                                  create_dt=now_dt,
+                                  expire_dt=now_dt + VALID_TTLS[params['ttl']][0]))
+
+        dao.insert_secrets(secrets)
+
+        response.status = 202
+        return {'secrets': [{'secret_id': secret.secret_id,
+                             'url': f'{service_address}/secrets/{secret.secret_id}',
+                             'expire_dt': rfc3339.datetimetostr(secret.expire_dt)}
+                            for secret in secrets]}
+
     @app.get('/secrets')
     @session_handler.require_session()
     def get_secrets():
+        params = parse_params(request.query.decode(),
+                              after=page_cursor_param('after'))
+        after = params.get('after')
+
         now_dt = rfc3339.now()
         user_id = request.session['user_id']
 
-        secrets = dao.find_secrets(user_id, now_dt)
+        # Fetch one extra secret to find out if there's another page after this one.
+        secrets = dao.find_secrets(user_id, now_dt, SECRETS_PAGE_SIZE + 1, after=after)
+
+        if len(secrets) > SECRETS_PAGE_SIZE:
+            secrets = secrets[:SECRETS_PAGE_SIZE]
+            last_secret = secrets[-1]
+            next_cursor = encode_page_cursor(last_secret.expire_dt, last_secret.secret_id)
+        else:
+            next_cursor = None
 
         return template('secrets',
                         service_address=service_address,
-                        secrets=secrets)
+                        secrets=secrets,
+                        next_cursor=next_cursor)
 
     @app.get('/secrets/<secret_id>')
     def get_secret(secret_id):
-        secret = dao.get_secret(secret_id)
+        secret = dao.get_secret_metadata(secret_id)
 
         if secret is None:
             abort(404, 'Oops, that secret can\'t be found.')
@@ -344,13 +485,13 @@ def construct_app(dao, token_decoder,
 
     @app.post('/secrets/<secret_id>')
     def post_secret(secret_id):
-        secret = dao.get_secret(secret_id)
+        # Fetch and delete in one go, so the secret can only ever be revealed once, even if
+        # multiple requests for it race each other.
+        secret = dao.claim_secret(secret_id)
 
         if secret is None:
             abort(404, 'Oops, that secret can\'t be found.')
 
-        dao.delete_secret(secret_id)
-
         return template('secret',
                         description=secret.description,
                         secret=secret.secret)
@@ -358,12 +499,128 @@ def construct_app(dao, token_decoder,
     return app
 
 
-def run_worker(dao, **kwargs):
-
-    while True:
-        now_dt = rfc3339.now()
-        deleted_secrets = dao.delete_expired_secrets(now_dt)
+WORKER_SLEEP_SECONDS = Histogram('shh_worker_sleep_seconds',
+                                 'How long the worker sleeps between runs.',
+                                 buckets=(0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300))
+WORKER_SLEEPS = Counter('shh_worker_sleeps_total',
+                        'Number of worker sleeps, by what determined their length.',
+                        labelnames=('reason',))
+WORKER_NEXT_EXPIRY_SECONDS = Gauge('shh_worker_next_expiry_seconds',
+                                   'Seconds until the next secret expires, as of the last run.')
+WORKER_ACTIVE = Gauge('shh_worker_active',
+                      'Whether this worker holds the worker lock, and so deletes expired secrets.')
+WORKER_DELETED_SECRETS = Counter('shh_worker_deleted_secrets_total',
+                                 'Number of expired secrets deleted.')
+WORKER_DELETE_CHUNKS = Counter('shh_worker_delete_chunks_total',
+                               'Number of expired secret deletion transactions run.')
+WORKER_DELETE_SECONDS = Histogram('shh_worker_delete_duration_seconds',
+                                  'How long each run of expired secret deletion took.')
+
+
+def run_worker(dao,
+               delete_chunk_size, delete_chunk_pause, delete_max_chunks,
+               min_sleep, max_sleep, expiry_batch_window,
+               worker_lock_name, standby_sleep,
+               metrics_file=None, metrics_dir=None,
+               **kwargs):
+
+    active = False
+
+    def check_active():
+        nonlocal active
+
+        # Only one worker - the holder of the worker lock - deletes secrets at a time. The others
+        # wait on standby in case it dies, at which point MySQL releases its lock.
+        was_active = active
+        active = dao.acquire_lock(worker_lock_name)
+        WORKER_ACTIVE.set(int(active))
+
+        if active and not was_active:
+            log.info('Acquired worker lock %(lock_name)s. Now the active worker.',
+                     {'lock_name': worker_lock_name})
+        elif was_active and not active:
+            log.warning('Lost worker lock %(lock_name)s. Now on standby.',
+                        {'lock_name': worker_lock_name})
+
+        return active
+
+    def delete_expired_secrets(now_dt):
+        start = time.perf_counter()
+        deleted_secrets, chunks = dao.delete_expired_secrets(now_dt,
+                                                             chunk_size=delete_chunk_size,
+                                                             chunk_pause=delete_chunk_pause,
+                                                             max_chunks=delete_max_chunks)
+        elapsed_time = time.perf_counter() - start
+        WORKER_DELETED_SECRETS.inc(deleted_secrets)
+        WORKER_DELETE_CHUNKS.inc(chunks)
+        WORKER_DELETE_SECONDS.observe(elapsed_time)
+
+        log_vals = {'deleted_secrets': deleted_secrets,
+                    'chunks': chunks,
+                    'elapsed_time': int(elapsed_time * 1000)}
         if deleted_secrets:
-            log.info('Deleted %(deleted_secrets)s secrets.',
-                     {'deleted_secrets': deleted_secrets})
-        time.sleep(60)
+            log.info('Deleted %(deleted_secrets)s secrets in %(chunks)s chunks in '
+                     '%(elapsed_time)sms.', log_vals)
+        else:
+            log.debug('Deleted no secrets in %(elapsed_time)sms.', log_vals)
+        # Every chunk being full means we stopped at the chunk limit, not because we ran out.
+        if deleted_secrets >= delete_max_chunks * delete_chunk_size:
+            log.warning('Hit the limit of %(max_chunks)s deletion chunks. Some expired secrets '
+                        'may remain until the next run.',
+                        {'max_chunks': delete_max_chunks})
+
+    def choose_sleep(now_dt, next_expire_dt):
+        if next_expire_dt is None:
+            return max_sleep, 'no_secrets'
+
+        # Sleep until a little after the next expiry, so any other secrets expiring shortly after
+        # it are deleted in the same run.
+        sleep_s = (next_expire_dt - now_dt).total_seconds() + expiry_batch_window
+        if sleep_s < min_sleep:
+            return min_sleep, 'floor'
+        if sleep_s > max_sleep:
+            return max_sleep, 'ceiling'
+        return sleep_s, 'next_expiry'
+
+    def run():
+        now_dt = rfc3339.now()
+        next_expire_dt = dao.get_next_expire_dt()
+
+        # Only bother deleting when something has actually expired.
+        if next_expire_dt is not None and next_expire_dt < now_dt:
+            delete_expired_secrets(now_dt)
+            now_dt = rfc3339.now()
+            next_expire_dt = dao.get_next_expire_dt()
+
+        if next_expire_dt is not None:
+            WORKER_NEXT_EXPIRY_SECONDS.set((next_expire_dt - now_dt).total_seconds())
+
+        return choose_sleep(now_dt, next_expire_dt)
+
+    try:
+        while True:
+            if check_active():
+                sleep_s, reason = run()
+            else:
+                sleep_s, reason = standby_sleep, 'standby'
+
+            WORKER_SLEEPS.labels(reason).inc()
+            WORKER_SLEEP_SECONDS.observe(sleep_s)
+            if metrics_file:
+                REGISTRY.write_textfile(metrics_file)
+            if metrics_dir:
+                # Snapshots are only written between sleeps, so allow for the longest sleep.
+                REGISTRY.write_snapshot(snapshot_path(metrics_dir, 'worker'),
+                                        stale_after=2 * max(max_sleep, standby_sleep))
+
+            log.debug('Sleeping %(sleep_s).1f seconds (%(reason)s).',
+                      {'sleep_s': sleep_s, 'reason': reason})
+            time.sleep(sleep_s)
+
+    finally:
+        if active:
+            try:
+                dao.release_lock(worker_lock_name)
+            except Exception:
+                log.exception('Failed to release worker lock %(lock_name)s.',
+                              {'lock_name': worker_lock_name})
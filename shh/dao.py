@@ -1,7 +1,10 @@
+import time
+
 from collections import namedtuple
 from datetime import timezone
+from pymysql.cursors import SSDictCursor
 
-from utils.fluent import InsertInto, Param, Select, Table, Wildcard
+from utils.fluent import DeleteFrom, InsertInto, Param, Select, Table, Wildcard
 
 
 Secret = namedtuple('Secret', ['secret_id',
@@ -12,6 +15,15 @@ Secret = namedtuple('Secret', ['secret_id',
                                'expire_dt'])
 SECRET_TABLE = Table('secret', columns=Secret._fields)
 
+# Everything about a secret except the secret itself. These columns are all covered by the
+# `idx_secret_user_id_expire_dt_secret_id_description` index, so listings can be served from the
+# index alone, without touching the (potentially large) secret values.
+SecretMetadata = namedtuple('SecretMetadata', ['secret_id',
+                                               'user_id',
+                                               'description',
+                                               'expire_dt'])
+SECRET_METADATA_COLUMNS = [SECRET_TABLE[c] for c in SecretMetadata._fields]
+
 
 def secret_to_db_format(secret):
     db_format_secret = secret._asdict()
@@ -35,6 +47,17 @@ def secret_from_db_format(db_format_secret):
     return Secret(**db_format_secret)
 
 
+def secret_metadata_from_db_format(db_format_secret_metadata):
+    db_format_secret_metadata = {k: v
+                                 for k, v in db_format_secret_metadata.items()
+                                 if k in SecretMetadata._fields}
+
+    db_format_secret_metadata['expire_dt'] = \
+        db_format_secret_metadata['expire_dt'].replace(tzinfo=timezone.utc)
+
+    return SecretMetadata(**db_format_secret_metadata)
+
+
 def create_db(conn, db_name):
     sql = (
         f'CREATE DATABASE IF NOT EXISTS `{db_name}` '
@@ -57,6 +80,55 @@ class ShhDao(object):
     def __init__(self, connection_pool):
         self.connection_pool = connection_pool
 
+        # The SQL for these statements never changes, so build it once up front, rather than on
+        # every call.
+        self.insert_secret_stmt = InsertInto(SECRET_TABLE) \
+            .columns(*SECRET_TABLE) \
+            .compile()
+
+        self.get_secret_stmt = Select(Wildcard) \
+            .from_table(SECRET_TABLE) \
+            .where(SECRET_TABLE['secret_id'] == Param('secret_id')) \
+            .compile()
+
+        self.get_secret_metadata_stmt = Select(*SECRET_METADATA_COLUMNS) \
+            .from_table(SECRET_TABLE) \
+            .where(SECRET_TABLE['secret_id'] == Param('secret_id')) \
+            .compile()
+
+        self.delete_secret_stmt = DeleteFrom(SECRET_TABLE) \
+            .where(SECRET_TABLE['secret_id'] == Param('secret_id')) \
+            .compile()
+
+        self.delete_expired_secrets_stmt = DeleteFrom(SECRET_TABLE) \
+            .where(SECRET_TABLE['expire_dt'] < Param('now_dt')) \
+            .order_by(SECRET_TABLE['expire_dt']) \
+            .limit(Param('chunk_size')) \
+            .compile()
+
+        self.claim_secret_stmt = Select(Wildcard) \
+            .from_table(SECRET_TABLE) \
+            .where(SECRET_TABLE['secret_id'] == Param('secret_id')) \
+            .for_update() \
+            .compile()
+
+        find_secrets_q = Select(*SECRET_METADATA_COLUMNS) \
+            .from_table(SECRET_TABLE) \
+            .where(SECRET_TABLE['user_id'] == Param('user_id')) \
+            .where(SECRET_TABLE['expire_dt'] > Param('now_dt'))
+        find_secrets_after_q = find_secrets_q \
+            .where((SECRET_TABLE['expire_dt'] > Param('after_expire_dt')) |
+                   ((SECRET_TABLE['expire_dt'] == Param('after_expire_dt')) &
+                    (SECRET_TABLE['secret_id'] > Param('after_secret_id'))))
+        self.find_secrets_stmt = find_secrets_q \
+            .order_by(SECRET_TABLE['expire_dt'], SECRET_TABLE['secret_id']) \
+            .limit(Param('limit')) \
+            .compile()
+        self.find_secrets_after_stmt = find_secrets_after_q \
+            .order_by(SECRET_TABLE['expire_dt'], SECRET_TABLE['secret_id']) \
+            .limit(Param('limit')) \
+            .compile()
+
     def create_secret_table(self):
         sql = (
             'CREATE TABLE IF NOT EXISTS `secret` ('
@@ -67,24 +139,45 @@ class ShhDao(object):
             '  `create_dt` DATETIME NOT NULL, '
             '  `expire_dt` DATETIME NOT NULL, '
             '  PRIMARY KEY (`secret_id`), '
-            '  KEY `idx_secret_user_id_expire_dt` (`user_id`, `expire_dt`), '
+            '  KEY `idx_secret_user_id_expire_dt_secret_id_description` '
+            '    (`user_id`, `expire_dt`, `secret_id`, `description`), '
             '  KEY `idx_secret_expire_dt` (`expire_dt`)'
             ') '
             'CHARACTER SET `utf8mb4`;'
         )
+        # Tables created before the covering listing index was added have a narrower index on
+        # just (`user_id`, `expire_dt`) instead. Swap it for the covering one.
+        find_index_sql = (
+            'SELECT `INDEX_NAME` FROM `information_schema`.`STATISTICS` '
+            'WHERE `TABLE_SCHEMA`=DATABASE() '
+            'AND `TABLE_NAME`=\'secret\' '
+            'AND `INDEX_NAME`=\'idx_secret_user_id_expire_dt\''
+            ';'
+        )
+        upgrade_index_sql = (
+            'ALTER TABLE `secret` '
+            '  ADD KEY `idx_secret_user_id_expire_dt_secret_id_description` '
+            '    (`user_id`, `expire_dt`, `secret_id`, `description`), '
+            '  DROP KEY `idx_secret_user_id_expire_dt`'
+            ';'
+        )
 
         conn = self.connection_pool.connection()
         try:
             with conn.cursor() as cursor:
                 cursor.execute(sql)
 
+                cursor.execute(find_index_sql)
+                if cursor.fetchone() is not None:
+                    cursor.execute(upgrade_index_sql)
+
             conn.commit()
 
         finally:
             conn.close()
 
     def insert_secret(self, secret):
-        sql = InsertInto(SECRET_TABLE).columns(*SECRET_TABLE).to_sql()
+        sql = self.insert_secret_stmt.sql
         sql_params = secret_to_db_format(secret)
 
         conn = self.connection_pool.connection()
@@ -97,11 +190,33 @@ class ShhDao(object):
         finally:
             conn.close()
 
+    def insert_secrets(self, secrets):
+        """Insert a batch of secrets with a single statement."""
+        if not secrets:
+            return
+
+        # Batch SQL depends on the batch size, so is built per call, rather than caching a
+        # statement for every size. Building it is cheap compared to executing it.
+        sql = InsertInto(SECRET_TABLE) \
+            .columns(*SECRET_TABLE) \
+            .rows(len(secrets)) \
+            .to_sql()
+        sql_params = {f'{k}_{i}': v
+                      for i, secret in enumerate(secrets)
+                      for k, v in secret_to_db_format(secret).items()}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, sql_params)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
     def get_secret(self, secret_id):
-        q = Select(Wildcard) \
-            .from_table(SECRET_TABLE) \
-            .where(SECRET_TABLE['secret_id'] == Param('secret_id'))
-        sql = q.to_sql()
+        sql = self.get_secret_stmt.sql
         sql_params = {'secret_id': secret_id}
 
         conn = self.connection_pool.connection()
@@ -119,34 +234,61 @@ class ShhDao(object):
         else:
             return None
 
-    def find_secrets(self, user_id, now_dt):
-        q = Select(Wildcard) \
-            .from_table(SECRET_TABLE) \
-            .where(SECRET_TABLE['user_id'] == Param('user_id')) \
-            .where(SECRET_TABLE['expire_dt'] > Param('now_dt')) \
-            .order_by(SECRET_TABLE['expire_dt'])
-        sql = q.to_sql()
-        sql_params = {'user_id': user_id,
-                      'now_dt': now_dt}
+    def get_secret_metadata(self, secret_id):
+        sql = self.get_secret_metadata_stmt.sql
+        sql_params = {'secret_id': secret_id}
 
         conn = self.connection_pool.connection()
         try:
             with conn.cursor() as cursor:
                 cursor.execute(sql, sql_params)
-                user_dicts = cursor.fetchall()
+                assert cursor.rowcount in (0, 1)
+                secret_metadata_dict = cursor.fetchone()
 
         finally:
             conn.close()
 
-        return [secret_from_db_format(user_dict) for user_dict in user_dicts]
+        if secret_metadata_dict is not None:
+            return secret_metadata_from_db_format(secret_metadata_dict)
+        else:
+            return None
 
-    def delete_secret(self, secret_id):
-        sql = (
-            'DELETE FROM `secret` '
-            'WHERE `secret_id`=%(secret_id)s'
-            ';'
-        )
+    def find_secrets(self, user_id, now_dt, limit, after=None):
+        """
+        Find the metadata of a user's unexpired secrets, soonest to expire first.
+
+        Results are paged by keyset on (`expire_dt`, `secret_id`). At most `limit` secrets are
+        returned. To fetch the next page, pass the (`expire_dt`, `secret_id`) of the last secret
+        in the previous page as `after`.
+        """
+        sql_params = {'user_id': user_id,
+                      'now_dt': now_dt,
+                      'limit': limit}
+
+        if after is not None:
+            after_expire_dt, after_secret_id = after
+            sql = self.find_secrets_after_stmt.sql
+            sql_params.update({'after_expire_dt': after_expire_dt,
+                               'after_secret_id': after_secret_id})
+        else:
+            sql = self.find_secrets_stmt.sql
+
+        conn = self.connection_pool.connection()
+        try:
+            # Use an unbuffered cursor, so rows are converted as they're streamed from the server,
+            # rather than all being buffered first.
+            with conn.cursor(SSDictCursor) as cursor:
+                cursor.execute(sql, sql_params)
+                secrets = [secret_metadata_from_db_format(secret_metadata_dict)
+                           for secret_metadata_dict in iter(cursor.fetchone, None)]
 
+        finally:
+            conn.close()
+
+        return secrets
+
+    def delete_secret(self, secret_id):
+        sql = self.delete_secret_stmt.sql
         sql_params = {'secret_id': secret_id}
 
         conn = self.connection_pool.connection()
@@ -162,23 +304,174 @@ class ShhDao(object):
 
         return bool(cursor.rowcount)
 
-    def delete_expired_secrets(self, now_dt):
+    def delete_secrets(self, secret_ids):
+        """Delete a batch of secrets with a single statement, returning how many were deleted."""
+        if not secret_ids:
+            return 0
+
+        # Like insert_secrets(), the SQL depends on the batch size, so is built per call.
+        in_clause = SECRET_TABLE['secret_id'].in_clause(secret_ids, 'secret_id')
+        sql = DeleteFrom(SECRET_TABLE) \
+            .where(in_clause) \
+            .to_sql()
+        sql_params = in_clause.build_params()
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, sql_params)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return cursor.rowcount
+
+    def claim_secret(self, secret_id):
+        """
+        Fetch and delete a secret in a single transaction.
+
+        The secret row is locked when read, so concurrent claims of the same secret are serialised.
+        Only the caller whose delete actually removed the row gets the secret - everyone else
+        gets None, as if the secret didn't exist.
+        """
+        select_sql = self.claim_secret_stmt.sql
+        delete_sql = self.delete_secret_stmt.sql
+        sql_params = {'secret_id': secret_id}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(select_sql, sql_params)
+                assert cursor.rowcount in (0, 1)
+                secret_dict = cursor.fetchone()
+
+                if secret_dict is None:
+                    conn.rollback()
+                    return None
+
+                cursor.execute(delete_sql, sql_params)
+                assert cursor.rowcount in (0, 1)
+                deleted = bool(cursor.rowcount)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        if deleted:
+            return secret_from_db_format(secret_dict)
+        else:
+            return None
+
+    def acquire_lock(self, lock_name):
+        """
+        Try to acquire (or confirm we still hold) a named MySQL advisory lock, without waiting.
+
+        Advisory locks belong to the MySQL session, so this relies on the connection pool handing
+        out the same connection every time, e.g. a pool of one connection. If that connection is
+        lost, MySQL releases the lock, and it has to be acquired again.
+        """
+        # GET_LOCK() on a lock this session already holds would stack another hold on it, which
+        # would then need an extra release - only call it if we don't hold the lock already.
         sql = (
-            'DELETE FROM `secret` '
-            'WHERE `expire_dt`<%(now_dt)s'
+            'SELECT IF(IS_USED_LOCK(%(lock_name)s)=CONNECTION_ID(), '
+            '          1, '
+            '          GET_LOCK(%(lock_name)s, 0)) AS `acquired`'
             ';'
         )
 
-        sql_params = {'now_dt': now_dt}
+        sql_params = {'lock_name': lock_name}
 
         conn = self.connection_pool.connection()
         try:
             with conn.cursor() as cursor:
                 cursor.execute(sql, sql_params)
+                acquired = cursor.fetchone()['acquired']
 
-            conn.commit()
+        finally:
+            conn.close()
+
+        return bool(acquired)
+
+    def release_lock(self, lock_name):
+        sql = (
+            'SELECT RELEASE_LOCK(%(lock_name)s) AS `released`'
+            ';'
+        )
+
+        sql_params = {'lock_name': lock_name}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, sql_params)
+                released = cursor.fetchone()['released']
 
         finally:
             conn.close()
 
-        return cursor.rowcount
+        return bool(released)
+
+    def get_next_expire_dt(self):
+        """Get the expiry datetime of the secret that expires (or expired) soonest, if any."""
+        sql = (
+            'SELECT MIN(`expire_dt`) AS `next_expire_dt` '
+            'FROM `secret`'
+            ';'
+        )
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+                next_expire_dt = cursor.fetchone()['next_expire_dt']
+
+        finally:
+            conn.close()
+
+        if next_expire_dt is not None:
+            return next_expire_dt.replace(tzinfo=timezone.utc)
+        else:
+            return None
+
+    def delete_expired_secrets(self, now_dt, chunk_size, chunk_pause, max_chunks):
+        """
+        Delete secrets that expired before `now_dt`, in chunks.
+
+        Each chunk deletes at most `chunk_size` of the oldest expired secrets in its own
+        transaction, to keep locks and undo log growth bounded. Chunks are run until no expired
+        secrets remain, or `max_chunks` have been run, sleeping `chunk_pause` seconds between each.
+
+        Returns the number of secrets deleted and the number of chunks run.
+        """
+        sql = self.delete_expired_secrets_stmt.sql
+        sql_params = {'now_dt': now_dt,
+                      'chunk_size': chunk_size}
+
+        deleted_secrets = 0
+        chunks = 0
+
+        conn = self.connection_pool.connection()
+        try:
+            while chunks < max_chunks:
+                if chunks and chunk_pause:
+                    time.sleep(chunk_pause)
+
+                with conn.cursor() as cursor:
+                    cursor.execute(sql, sql_params)
+
+                conn.commit()
+
+                chunks += 1
+                deleted_secrets += cursor.rowcount
+
+                # A partial chunk means there are no expired secrets left.
+                if cursor.rowcount < chunk_size:
+                    break
+
+        finally:
+            conn.close()
+
+        return deleted_secrets, chunks
@@ -1,14 +1,29 @@
+import binascii
 import hashlib
+import json
+import re
+import rfc3339
 import secrets
 import textwrap
 
-from base64 import urlsafe_b64encode
-from bottle import HTTPResponse, response, template
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bottle import HTTPResponse, SimpleTemplate, cached_property, html_escape, response, touni
+from collections import OrderedDict
 from bottle import abort as bottle_abort
+from bottle import template as bottle_template
+from utils.param_parse import InvalidParamError, param_parser
 from utils.security_headers import SecurityHeadersPlugin
 
 ID_BYTES = 16
 HASH_BYTES = 16
+RENDER_CACHE_SIZE = 1000
+# How far base.tpl indents the body of the pages based on it.
+BASE_INDENT = 4
+
+# Matches `rebase()` calls in both `%` lines and `<% %>` blocks, capturing their arguments.
+REBASE_REGEX = re.compile(r'^\s*(?:<?%)?\s*rebase\((.*?)\)\s*(?:%>)?$',
+                          re.MULTILINE | re.DOTALL)
+NO_INDENT_REGEX = re.compile(r'\bdo_indent\s*=\s*False\b')
 
 
 # Have no text by default, unlike the default bottle abort function
@@ -28,11 +43,89 @@ def hash_urlsafe(value):
     return urlsafe_b64encode(hash_bytes).decode('utf-8').replace('=', '')
 
 
+def encode_page_cursor(expire_dt, secret_id):
+    """Encode the keyset of the last secret in a page as an opaque, url safe cursor"""
+    cursor = f'{rfc3339.datetimetostr(expire_dt)}:{secret_id}'
+    return urlsafe_b64encode(cursor.encode('utf-8')).decode('utf-8').replace('=', '')
+
+
+def page_cursor_param(*keys, default=None, required=False):
+
+    @param_parser(*keys, default=default, required=required, strip=True)
+    def parse(k, v):
+        try:
+            padding = '=' * (-len(v) % 4)
+            cursor = urlsafe_b64decode((v + padding).encode('utf-8')).decode('utf-8')
+            expire_dt_str, secret_id = cursor.rsplit(':', 1)
+            expire_dt = rfc3339.parse_datetime(expire_dt_str)
+        except (binascii.Error, ValueError):
+            raise InvalidParamError(k, v, 'Must be a valid page cursor')
+
+        return expire_dt, secret_id
+
+    return parse
+
+
 def indent(block, indent=2):
     """Indent a multi-line text block by a number of spaces"""
     return textwrap.indent(block.strip(), ' ' * indent)
 
 
+def indent_template_source(source, indent):
+    """Indent the text lines of a template's source by a number of spaces, leaving code lines"""
+    prefix = ' ' * indent
+    lines = []
+    in_block = False
+    for line in source.splitlines(keepends=True):
+        stripped = line.lstrip()
+        if in_block:
+            in_block = '%>' not in line
+            lines.append(line)
+        elif stripped.startswith('<%'):
+            in_block = '%>' not in stripped
+            lines.append(line)
+        elif stripped.startswith('%') or not stripped:
+            lines.append(line)
+        else:
+            lines.append(prefix + line)
+    return ''.join(lines)
+
+
+class IndentedTemplate(SimpleTemplate):
+    """
+    A SimpleTemplate that indents pages based on base.tpl when they're compiled, rather than when
+    they're rendered.
+
+    Only the template's own text is indented, so unlike indenting the rendered output, multi-line
+    values aren't altered. Pages that pass `do_indent=False` to `rebase()` aren't indented.
+    """
+    pre_indented = False
+
+    @cached_property
+    def code(self):
+        if not self.source:
+            with open(self.filename, 'rb') as f:
+                self.source = f.read()
+
+        source = touni(self.source)
+        rebase_match = REBASE_REGEX.search(source)
+        if rebase_match and not NO_INDENT_REGEX.search(rebase_match.group(1)):
+            self.source = indent_template_source(source, BASE_INDENT)
+            self.pre_indented = True
+
+        return SimpleTemplate.code.func(self)
+
+    def _rebase(self, _env, _name=None, **kwargs):
+        # Let the base template know it doesn't need to indent this page itself.
+        super(IndentedTemplate, self)._rebase(_env, _name, pre_indented=self.pre_indented, **kwargs)
+
+
+def template(*args, **kwargs):
+    # Bottle caches compiled templates by name, regardless of the adapter that compiled them, so
+    # pages should always be rendered with this rather than bottle's template().
+    return bottle_template(*args, template_adapter=IndentedTemplate, **kwargs)
+
+
 def set_headers(r, headers):
     if isinstance(r, HTTPResponse):
         r.headers.update(headers)
@@ -49,11 +142,76 @@ csp_updates = {'img-src': "'self'",
 security_headers = SecurityHeadersPlugin(csp_updates=csp_updates)
 
 
+class RenderCache(object):
+    """
+    A size bounded LRU cache of rendered templates, encoded ready to send.
+
+    Only use it for templates whose output depends on nothing but their parameters - i.e. not the
+    session, or any other request state - and whose parameters have few distinct values.
+    """
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def render(self, name, **params):
+        key = (name, tuple(sorted(params.items())))
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+            return body
+
+        body = template(name, **params).encode('utf-8')
+        self.entries[key] = body
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return body
+
+    def render_with_placeholder(self, name, placeholder, **params):
+        """
+        Render a template with `placeholder` as one of its parameters, to be substituted later.
+
+        Returns a function that takes the actual value of that parameter, and returns the page
+        with it substituted in - escaped, as the template would have.
+        """
+        placeholder_param, placeholder_value = placeholder
+        body = self.render(name, **params, **{placeholder_param: placeholder_value})
+        prefix, suffix = body.split(html_escape(placeholder_value).encode('utf-8'))
+
+        def substitute(value):
+            return b''.join((prefix, html_escape(value).encode('utf-8'), suffix))
+
+        return substitute
+
+
+render_cache = RenderCache()
+
+
+def error_message(res):
+    """The message to show on an error page, or None for a generic one."""
+    if res.status_code == 404:
+        # Don't show bottle's default message for unknown routes.
+        if res.body and not res.body.startswith('Not found: '):
+            return res.body
+    elif res.body and res.status_code < 500:
+        return res.body
+
+    return None
+
+
+def json_error(status, message, **fields):
+    """A JSON error response for API clients, rather than an HTML error page."""
+    return HTTPResponse(json.dumps({'error': message, **fields}),
+                        status=status,
+                        headers={'Content-Type': 'application/json'})
+
+
 @security_headers
 def html_default_error_hander(res):
+    # Error pages only depend on their message, so are served from the render cache. Those with
+    # the default message are pre-rendered by construct_app().
     if res.status_code == 404:
-        body = template('error_404', error=res)
+        return render_cache.render('error_404', message=error_message(res))
     else:
-        body = template('error', error=res)
+        return render_cache.render('error', message=error_message(res))
 
-    return body
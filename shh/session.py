@@ -1,13 +1,21 @@
 import binascii
 import functools
+import glob
+import hashlib
 import jwt
 import logging
+import os
+import time
 
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 from bottle import request, response, redirect
+from collections import OrderedDict
+from jwt.algorithms import RSAAlgorithm
 from jwt.exceptions import InvalidTokenError, ExpiredSignatureError
 from urllib.parse import urlencode
 
+from utils.metrics import Counter, Gauge
+
 from .misc import abort, set_headers
 
 log = logging.getLogger(__name__)
@@ -19,6 +27,12 @@ OIDC_DATA_MAX_AGE = 60 * 10  # 10 minutes
 SESSION_COOKIE = 'shh_session'
 SESSION_MAX_AGE = 60 * 60 * 24  # 24 hours
 REFRESH_SESSION_COOKIE = 'shh_refresh_session'
+
+SESSION_CACHE_LOOKUPS = Counter('shh_session_cache_lookups_total',
+                                'Number of session cache lookups, by result.',
+                                labelnames=('result',))
+SESSION_CACHE_ENTRIES = Gauge('shh_session_cache_entries',
+                              'Number of sessions in the session cache.')
 # Headers to prevent responses that use a session from being cached.
 CACHE_HEADERS = {
     'Pragma': 'no-cache',
@@ -26,28 +40,139 @@ CACHE_HEADERS = {
 }
 
 
-class TokenDecoder(object):
+def load_public_key(public_key):
+    """Parse a PEM (or OpenSSH) encoded RSA public key."""
+    return RSAAlgorithm(RSAAlgorithm.SHA256).prepare_key(public_key)
+
 
-    def __init__(self, oidc_public_key, oidc_iss, oidc_client_id):
-        self.oidc_public_key = oidc_public_key
+class TokenDecoder(object):
+    """
+    Verifies and decodes ID tokens from the OIDC provider.
+
+    Public keys are parsed once, up front, rather than for every token. Tokens are verified with
+    the key matching their `kid` header, if any. Keys for other key IDs can be added by placing
+    `<kid>.pub` files in `oidc_public_key_dir` - the directory is rescanned (at most once every
+    `KEY_RELOAD_INTERVAL` seconds) when a token with an unknown key ID is seen, so keys can be
+    rotated without a restart. Tokens without a key ID, or with an ID that doesn't match a key, are
+    verified with the default key, `oidc_public_key`.
+    """
+
+    KEY_RELOAD_INTERVAL = 60
+
+    def __init__(self, oidc_public_key, oidc_iss, oidc_client_id, oidc_public_key_dir=None):
+        self.oidc_public_key = load_public_key(oidc_public_key) if oidc_public_key else None
+        self.oidc_public_key_dir = oidc_public_key_dir
         self.oidc_iss = oidc_iss
         self.oidc_client_id = oidc_client_id
 
+        self.oidc_public_keys = {}
+        self.keys_loaded_at = None
+        if self.oidc_public_key_dir:
+            self.reload_keys()
+
+    def reload_keys(self):
+        oidc_public_keys = {}
+        for path in sorted(glob.glob(os.path.join(self.oidc_public_key_dir, '*.pub'))):
+            kid = os.path.splitext(os.path.basename(path))[0]
+            try:
+                with open(path, 'rb') as f:
+                    oidc_public_keys[kid] = load_public_key(f.read())
+            except (OSError, ValueError) as e:
+                log.warning('Failed to load OIDC public key %(kid)s: %(error)s',
+                            {'kid': kid, 'error': e})
+
+        added_kids = oidc_public_keys.keys() - self.oidc_public_keys.keys()
+        if added_kids:
+            log.info('Loaded OIDC public keys %(kids)s.', {'kids': ', '.join(sorted(added_kids))})
+
+        self.oidc_public_keys = oidc_public_keys
+        self.keys_loaded_at = time.monotonic()
+
+    def get_key(self, kid):
+        if kid is None:
+            return self.oidc_public_key
+
+        key = self.oidc_public_keys.get(kid)
+
+        # Possibly a new key - check for it, but not too often, to avoid scanning the key directory
+        # for every token with a bogus key ID.
+        if key is None and self.oidc_public_key_dir and \
+                time.monotonic() - self.keys_loaded_at >= self.KEY_RELOAD_INTERVAL:
+            self.reload_keys()
+            key = self.oidc_public_keys.get(kid)
+
+        return key or self.oidc_public_key
+
     def decode_id_token(self, token):
-        payload = jwt.decode(token, self.oidc_public_key,
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = self.get_key(kid)
+        if key is None:
+            raise InvalidTokenError(f'No public key for key ID {kid}')
+
+        payload = jwt.decode(token, key,
                              algorithms='RS256',
                              issuer=self.oidc_iss,
                              audience=self.oidc_client_id)
         return payload
 
 
+class SessionCache(object):
+    """
+    A size bounded LRU cache of sessions decoded from verified session tokens.
+
+    Verifying a session token's signature is expensive, and the same token is sent with every
+    request for the life of the session, so cache the result. Entries are keyed by a hash of the
+    token, rather than the token itself, and are dropped once the token expires.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        SESSION_CACHE_ENTRIES.set_function(lambda: len(self.entries))
+
+    @staticmethod
+    def key(id_token):
+        return hashlib.blake2b(id_token.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, id_token):
+        if self.max_size <= 0:
+            SESSION_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+
+        key = self.key(id_token)
+        entry = self.entries.get(key)
+        if entry is not None:
+            session, expire_ts = entry
+            if expire_ts > time.time():
+                self.entries.move_to_end(key)
+                SESSION_CACHE_LOOKUPS.labels('hit').inc()
+                return session
+
+            del self.entries[key]
+
+        SESSION_CACHE_LOOKUPS.labels('miss').inc()
+        return None
+
+    def put(self, id_token, session, expire_ts):
+        if self.max_size <= 0:
+            return
+
+        key = self.key(id_token)
+        self.entries[key] = (session, expire_ts)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
 class SessionHandler(object):
 
-    def __init__(self, token_decoder, login_endpoint='login', testing_mode=False):
+    def __init__(self, token_decoder, login_endpoint='login', testing_mode=False,
+                 session_cache_size=0):
 
         self.token_decoder = token_decoder
         self.login_endpoint = login_endpoint
         self.testing_mode = testing_mode
+        self.session_cache = SessionCache(session_cache_size)
         # Add prefix to cookies to make them "domain locked" to improve security.
         # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Set-Cookie#Cookie_prefixes
         self.oidc_data_cookie_prefix = OIDC_DATA_COOKIE_PREFIX if self.testing_mode else f'__Host-{OIDC_DATA_COOKIE_PREFIX}'
@@ -121,6 +246,10 @@ class SessionHandler(object):
         if not id_token:
             return None
 
+        session = self.session_cache.get(id_token)
+        if session is not None:
+            return session
+
         try:
             session_jwt = self.token_decoder.decode_id_token(id_token)
 
@@ -132,9 +261,14 @@ class SessionHandler(object):
             log.warning('Received invalid session token: %(error)s', {'error': e})
             return None
 
-        return {'user_id': session_jwt['sub'],
-                # Use id token id as the CSRF token.
-                'csrf': session_jwt['jti']}
+        session = {'user_id': session_jwt['sub'],
+                   # Use id token id as the CSRF token.
+                   'csrf': session_jwt['jti']}
+        # ID tokens always have an expiry, but only cache the session if it's actually set.
+        if 'exp' in session_jwt:
+            self.session_cache.put(id_token, session, session_jwt['exp'])
+
+        return session
 
     def _should_refresh_session(self):
         refresh_session_val = request.get_cookie(self.refresh_session_cookie)
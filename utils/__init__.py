@@ -41,7 +41,7 @@ def nice_shutdown(shutdown=sys.exit, shutdown_signals=(signal.SIGINT, signal.SIG
     Logs shutdown signals nicely, and calls a shutdown function.
 
     Installs new handlers for the shutdown signals (SIGINT and SIGTERM by default).
-    The original handlers are restored before returning.
+    The original handlers are restored, and log handlers flushed, before returning.
     """
 
     shutting_down = False
@@ -72,3 +72,9 @@ def nice_shutdown(shutdown=sys.exit, shutdown_signals=(signal.SIGINT, signal.SIG
         # Restore the old handlers
         for sig, old_handler in old_handlers.items():
             signal.signal(sig, old_handler)
+
+        # Make sure any buffered logs are written before exiting.
+        # NOTE: `logging` here is shadowed by the utils.logging module once that's imported, so get
+        #       the root logger via our own.
+        for handler in log.root.handlers:
+            handler.flush()
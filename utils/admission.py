@@ -0,0 +1,105 @@
+from gevent.lock import Semaphore
+
+from utils.metrics import Counter, Gauge
+
+ADMISSION_IN_FLIGHT = Gauge('shh_admission_in_flight_requests',
+                            'Number of requests currently admitted.')
+ADMISSION_QUEUED = Gauge('shh_admission_queued_requests',
+                         'Number of requests currently waiting to be admitted.')
+ADMISSION_REJECTED = Counter('shh_admission_rejected_requests_total',
+                             'Number of requests rejected by admission control.',
+                             labelnames=('reason',))
+
+UNAVAILABLE_BODY = b'Service Unavailable'
+
+
+class ReleasingIterable(object):
+    """
+    Wraps a WSGI response iterable, calling `release` once the server has closed it.
+
+    The response may still be being generated until then, so the request is still in flight.
+    """
+
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.release()
+
+
+def admission_control_middleware(application, max_concurrency, max_queue, queue_timeout,
+                                 retry_after, bypass_paths=('/-/live', '/-/ready', '/-/metrics')):
+    """
+    WSGI middleware to limit the number of requests handled concurrently.
+
+    At most `max_concurrency` requests are handled at once. Up to `max_queue` more wait to be
+    admitted, for at most `queue_timeout` seconds. Requests that can't be queued, or time out while
+    queued, get a fast 503 response with a `Retry-After` header, rather than piling up behind
+    the database connection pool.
+
+    Requests for `bypass_paths` (e.g. health checks and metrics) are always handled immediately.
+    """
+
+    semaphore = Semaphore(max_concurrency)
+    queued = 0
+
+    unavailable_headers = [
+        ('Content-Type', 'text/plain; charset=UTF-8'),
+        ('Content-Length', str(len(UNAVAILABLE_BODY))),
+        ('Retry-After', str(retry_after)),
+        ('Cache-Control', 'no-store'),
+    ]
+
+    def reject(start_response, reason):
+        ADMISSION_REJECTED.labels(reason).inc()
+        start_response('503 Service Unavailable', list(unavailable_headers))
+        return [UNAVAILABLE_BODY]
+
+    def release():
+        ADMISSION_IN_FLIGHT.dec()
+        semaphore.release()
+
+    def admission_control_wrapper(environ, start_response):
+        nonlocal queued
+
+        if environ.get('PATH_INFO') in bypass_paths:
+            return application(environ, start_response)
+
+        if not semaphore.acquire(blocking=False):
+            if queued >= max_queue:
+                return reject(start_response, 'queue_full')
+
+            queued += 1
+            ADMISSION_QUEUED.inc()
+            try:
+                acquired = semaphore.acquire(timeout=queue_timeout)
+            finally:
+                queued -= 1
+                ADMISSION_QUEUED.dec()
+
+            if not acquired:
+                return reject(start_response, 'queue_timeout')
+
+        ADMISSION_IN_FLIGHT.inc()
+        try:
+            retval = application(environ, start_response)
+        except BaseException:
+            release()
+            raise
+
+        # Common case - the response has already been generated, so the request is done.
+        if isinstance(retval, (list, tuple)):
+            release()
+            return retval
+
+        return ReleasingIterable(retval, release)
+
+    return admission_control_wrapper
@@ -0,0 +1,174 @@
+import gzip
+import zlib
+
+from utils.logging import is_file_wrapper
+
+# Only compress types that benefit from it - images etc. are already compressed.
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/manifest+json', 'application/xml', 'image/svg+xml',
+                      'image/x-icon', 'image/vnd.microsoft.icon')
+
+
+def parse_accept_encoding(accept_encoding):
+    """Parse an Accept-Encoding header into a dict of lowercase coding -> quality value."""
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        coding, *params = coding.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def accepted_encodings(accept_encoding, codings):
+    """
+    The subset of `codings` a client accepts, according to its Accept-Encoding header.
+
+    A coding listed explicitly takes precedence over `*`, so e.g. `gzip;q=0, *` doesn't accept
+    gzip, while `*;q=0, gzip` does.
+    """
+    qualities = parse_accept_encoding(accept_encoding)
+    wildcard = qualities.get('*', 0)
+    return {coding for coding in codings if qualities.get(coding, wildcard) > 0}
+
+
+def add_vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if 'accept-encoding' not in value.lower():
+                headers[i] = (name, f'{value}, Accept-Encoding')
+            return
+    headers.append(('Vary', 'Accept-Encoding'))
+
+
+def is_compressible(environ, status, headers, min_size):
+    if environ.get('REQUEST_METHOD') == 'HEAD':
+        return False
+
+    if status[:3] in ('204', '206', '304') or status[0] == '1':
+        return False
+
+    content_type = None
+    for name, value in headers:
+        name = name.lower()
+        if name == 'content-encoding':
+            return False
+        if name == 'content-length' and int(value) < min_size:
+            return False
+        if name == 'cache-control' and 'no-transform' in value.lower():
+            return False
+        if name == 'content-type':
+            content_type = value.lower()
+
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class GzipIterable(object):
+    """Wraps a WSGI response iterable, gzip compressing it as it's streamed."""
+
+    def __init__(self, iterable, level):
+        self.iterable = iterable
+        self.level = level
+
+    def __iter__(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in self.iterable:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+
+def gzip_middleware(application, min_size=1024, level=6):
+    """
+    WSGI middleware to gzip compress responses, for clients that accept it.
+
+    Only textual responses of at least `min_size` bytes are compressed. Responses that are already
+    encoded, or have `Cache-Control: no-transform`, are left alone.
+
+    Responses are returned as iterables the server can stream, with a `close()` method that closes
+    the original response, so this can be wrapped by wsgi_log_middleware to count the bytes sent.
+    """
+
+    def gzip_wrapper(environ, start_response):
+        # start_response is delayed until the app returns its body, so complete bodies can be
+        # compressed in one go, and given an accurate content-length.
+        pending = []
+        started = False
+        returned = False
+        write = None
+
+        def start(status, headers, exc_info=None):
+            nonlocal started, write
+            started = True
+            write = start_response(status, headers, exc_info)
+            return write
+
+        def custom_start_response(status, headers, exc_info=None):
+            # Too late to delay - the app is calling start_response while its body is iterated,
+            # or is replacing the response after an error.
+            if returned or started:
+                return start(status, headers, exc_info)
+
+            pending[:] = [(status, list(headers), exc_info)]
+            return deferred_write
+
+        def deferred_write(data):
+            # Apps using write() can't be compressed, as we don't see the whole body.
+            if not started:
+                start(*pending[0])
+            return write(data)
+
+        retval = application(environ, custom_start_response)
+        returned = True
+
+        if started or not pending:
+            return retval
+
+        status, headers, exc_info = pending[0]
+
+        if is_file_wrapper(environ, retval) or \
+                not is_compressible(environ, status, headers, min_size):
+            start(status, headers, exc_info)
+            return retval
+
+        add_vary(headers)
+
+        if not accepted_encodings(environ.get('HTTP_ACCEPT_ENCODING', ''), ('gzip',)):
+            start(status, headers, exc_info)
+            return retval
+
+        if isinstance(retval, (list, tuple)):
+            body = b''.join(retval)
+            if len(body) < min_size:
+                start(status, headers, exc_info)
+                return [body]
+
+            body = gzip.compress(body, compresslevel=level, mtime=0)
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Content-Length', str(len(body))))
+            start(status, headers, exc_info)
+            return [body]
+
+        headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', 'gzip'))
+        start(status, headers, exc_info)
+        return GzipIterable(retval, level)
+
+    return gzip_wrapper
@@ -1,3 +1,4 @@
+from collections import namedtuple
 from enum import Enum
 
 
@@ -20,6 +21,10 @@ class JoinTypes(Enum):
     outer = 'OUTER JOIN'
 
 
+# The output of compiling a statement builder. Immutable, so it can be built once and shared.
+CompiledStatement = namedtuple('CompiledStatement', ['sql'])
+
+
 class Table:
 
     def __init__(self, name, alias=None, columns=None):
@@ -276,6 +281,53 @@ class Join:
         self.clause = clause
 
 
+def format_value(v):
+    if isinstance(v, ColumnAlias):
+        return f'`{v.alias}`'
+
+    elif isinstance(v, BasicColumn):
+        if v.alias is not None:
+            return f'`{v.alias}`'
+        else:
+            return f'`{v.table.aliased_name()}`.`{v.name}`'
+
+    elif isinstance(v, Param):
+        return f'%({v.name})s'
+
+    else:
+        raise NotImplementedError
+
+
+def format_clause(c, nested=False):
+    if isinstance(c, BasicClause):
+        left_stmt = format_value(c.left)
+        right_stmt = format_value(c.right)
+        stmt = f'{left_stmt} {c.op.value} {right_stmt}'
+
+    elif isinstance(c, InClause):
+        column_stmt = format_value(c.column)
+        op_stmt = 'NOT IN' if c.inverted else 'IN'
+        values_stmt = ', '.join(f'%({c.prefix}_{i})s'
+                                for i in range(len(c.values)))
+        stmt = f'{column_stmt} {op_stmt} ({values_stmt})'
+
+    elif isinstance(c, CombinedClause):
+        sub_clauses = [format_clause(sc, nested=True)
+                       for sc in c.clauses]
+        stmt = f' {c.op.value} '.join(sub_clauses)
+        if nested:
+            stmt = f'({stmt})'
+
+    elif isinstance(c, NegatedClause):
+        stmt = format_clause(c.clause, nested=True)
+        stmt = f'NOT {stmt}'
+
+    else:
+        raise NotImplementedError
+
+    return stmt
+
+
 class Select:
 
     def __init__(self,
@@ -283,13 +335,17 @@ class Select:
                  from_tables=None,
                  joins=None,
                  where_clause=None,
-                 order_by_columns=None):
+                 order_by_columns=None,
+                 limit_value=None,
+                 lock_for_update=False):
 
         self.select_columns = select_columns
         self.from_tables = from_tables
         self.joins = joins
         self.where_clause = where_clause
         self.order_by_columns = order_by_columns
+        self.limit_value = limit_value
+        self.lock_for_update = lock_for_update
 
     def copy(self, *select_columns, **kwargs):
         if not select_columns:
@@ -299,6 +355,8 @@ class Select:
                          'joins': self.joins,
                          'where_clause': self.where_clause,
                          'order_by_columns': self.order_by_columns,
+                         'limit_value': self.limit_value,
+                         'lock_for_update': self.lock_for_update,
                          **kwargs})
 
     def from_table(self, *tables):
@@ -331,6 +389,14 @@ class Select:
 
         return self.copy(order_by_columns=order_by_columns)
 
+    def limit(self, value):
+        # Either a fixed row count, or a Param to supply it at execution time.
+        assert isinstance(value, (int, Param))
+        return self.copy(limit_value=value)
+
+    def for_update(self):
+        return self.copy(lock_for_update=True)
+
     def to_sql(self):
 
         def format_column(c):
@@ -356,51 +422,6 @@ class Select:
             else:
                 return f'`{t.name}`'
 
-        def format_value(v):
-            if isinstance(v, ColumnAlias):
-                return f'`{v.alias}`'
-
-            elif isinstance(v, BasicColumn):
-                if v.alias is not None:
-                    return f'`{v.alias}`'
-                else:
-                    return f'`{v.table.aliased_name()}`.`{v.name}`'
-
-            elif isinstance(v, Param):
-                return f'%({v.name})s'
-
-            else:
-                raise NotImplementedError
-
-        def format_clause(c, nested=False):
-            if isinstance(c, BasicClause):
-                left_stmt = format_value(c.left)
-                right_stmt = format_value(c.right)
-                stmt = f'{left_stmt} {c.op.value} {right_stmt}'
-
-            elif isinstance(c, InClause):
-                column_stmt = format_value(c.column)
-                op_stmt = 'NOT IN' if c.inverted else 'IN'
-                values_stmt = ', '.join(f'%({c.prefix}_{i})s'
-                                        for i in range(len(c.values)))
-                stmt = f'{column_stmt} {op_stmt} ({values_stmt})'
-
-            elif isinstance(c, CombinedClause):
-                sub_clauses = [format_clause(sc, nested=True)
-                               for sc in c.clauses]
-                stmt = f' {c.op.value} '.join(sub_clauses)
-                if nested:
-                    stmt = f'({stmt})'
-
-            elif isinstance(c, NegatedClause):
-                stmt = format_clause(c.clause, nested=True)
-                stmt = f'NOT {stmt}'
-
-            else:
-                raise NotImplementedError
-
-            return stmt
-
         def format_join(j):
             table_stmt = format_table(j.table)
             clause_stmt = format_clause(j.clause)
@@ -427,23 +448,39 @@ class Select:
                                      for c in self.order_by_columns)
             sql += f' ORDER BY {order_by_stmt}'
 
+        if self.limit_value is not None:
+            if isinstance(self.limit_value, Param):
+                limit_stmt = format_value(self.limit_value)
+            else:
+                limit_stmt = str(self.limit_value)
+            sql += f' LIMIT {limit_stmt}'
+
+        if self.lock_for_update:
+            sql += ' FOR UPDATE'
+
         return sql + ';'
 
+    def compile(self):
+        return CompiledStatement(self.to_sql())
+
 
 class Insert:
 
     def __init__(self,
                  into_table,
-                 into_columns=None):
+                 into_columns=None,
+                 row_count=None):
 
         self.into_table = into_table
         self.into_columns = into_columns
+        self.row_count = row_count
 
     def copy(self, into_table=None, **kwargs):
         if not into_table:
             into_table = self.into_table
         return Insert(into_table,
                       **{'into_columns': self.into_columns,
+                         'row_count': self.row_count,
                          **kwargs})
 
     def columns(self, *columns):
@@ -452,6 +489,15 @@ class Insert:
 
         return self.copy(into_columns=into_columns)
 
+    def rows(self, row_count):
+        """
+        Insert multiple rows in one statement.
+
+        The value parameters for each row are suffixed with the row's index, e.g. `%(name_0)s`.
+        """
+        assert row_count >= 1
+        return self.copy(row_count=row_count)
+
     def to_sql(self):
 
         def format_table(t):
@@ -467,24 +513,111 @@ class Insert:
             else:
                 raise NotImplementedError
 
-        def format_value(c):
-            # Each column has a corresponding value parameter
+        def format_value(c, row_index=None):
+            # Each column has a corresponding value parameter (per row)
             if isinstance(c, BasicColumn):
                 assert c.table == self.into_table
-                return f'%({c.name})s'
+                if row_index is None:
+                    return f'%({c.name})s'
+                else:
+                    return f'%({c.name}_{row_index})s'
 
             else:
                 raise NotImplementedError
 
+        def format_row(row_index=None):
+            values_stmt = ', '.join(format_value(c, row_index) for c in self.into_columns)
+            return f'({values_stmt})'
+
         assert self.into_columns
 
         table_stmt = format_table(self.into_table)
         columns_stmt = ', '.join(format_column(c) for c in self.into_columns)
-        values_stmt = ', '.join(format_value(c) for c in self.into_columns)
-        sql = f'INSERT INTO {table_stmt} ({columns_stmt}) VALUES ({values_stmt});'
+        if self.row_count is None:
+            rows_stmt = format_row()
+        else:
+            rows_stmt = ', '.join(format_row(i) for i in range(self.row_count))
+        sql = f'INSERT INTO {table_stmt} ({columns_stmt}) VALUES {rows_stmt};'
 
         return sql
 
+    def compile(self):
+        return CompiledStatement(self.to_sql())
+
 
 # For convenience/clarity
 InsertInto = Insert
+
+
+class Delete:
+
+    def __init__(self,
+                 from_table,
+                 where_clause=None,
+                 order_by_columns=None,
+                 limit_value=None):
+
+        self.from_table = from_table
+        self.where_clause = where_clause
+        self.order_by_columns = order_by_columns
+        self.limit_value = limit_value
+
+    def copy(self, from_table=None, **kwargs):
+        if not from_table:
+            from_table = self.from_table
+        return Delete(from_table,
+                      **{'where_clause': self.where_clause,
+                         'order_by_columns': self.order_by_columns,
+                         'limit_value': self.limit_value,
+                         **kwargs})
+
+    def where(self, clause):
+        if self.where_clause is not None:
+            clause = self.where_clause & clause
+
+        return self.copy(where_clause=clause)
+
+    def order_by(self, *columns):
+        order_by_columns = [] if self.order_by_columns is None else self.order_by_columns
+        order_by_columns = [*order_by_columns, *columns]
+
+        return self.copy(order_by_columns=order_by_columns)
+
+    def limit(self, value):
+        # Either a fixed row count, or a Param to supply it at execution time.
+        assert isinstance(value, (int, Param))
+        return self.copy(limit_value=value)
+
+    def to_sql(self):
+
+        def format_table(t):
+            # NOTE: Aliases aren't used in single table DELETE stmts
+            return f'`{t.name}`'
+
+        table_stmt = format_table(self.from_table)
+        sql = f'DELETE FROM {table_stmt}'
+
+        if self.where_clause:
+            where_stmt = format_clause(self.where_clause)
+            sql += f' WHERE {where_stmt}'
+
+        if self.order_by_columns:
+            order_by_stmt = ','.join(format_value(c)
+                                     for c in self.order_by_columns)
+            sql += f' ORDER BY {order_by_stmt}'
+
+        if self.limit_value is not None:
+            if isinstance(self.limit_value, Param):
+                limit_stmt = format_value(self.limit_value)
+            else:
+                limit_stmt = str(self.limit_value)
+            sql += f' LIMIT {limit_stmt}'
+
+        return sql + ';'
+
+    def compile(self):
+        return CompiledStatement(self.to_sql())
+
+
+# For convenience/clarity
+DeleteFrom = Delete
@@ -0,0 +1,109 @@
+import logging
+import requests
+import time
+
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+
+def construct_session(pool_size=10, retries=2, backoff_factor=0.5):
+    """
+    Construct a requests session with a pool of keep-alive connections.
+
+    Only connection errors are retried, with exponential backoff. These happen before the request is
+    sent, so are always safe to retry. Errors reading the response aren't retried, as the request
+    may not be idempotent.
+
+    The session is shared between requests, so it doesn't store cookies - they'd otherwise be
+    shared between users.
+    """
+    retry = Retry(total=retries, connect=retries, read=0, status=0,
+                  backoff_factor=backoff_factor, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    return session
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls fast while a dependency is down.
+
+    After `failure_threshold` consecutive failed calls the circuit opens, and calls raise
+    CircuitOpenError without being attempted. After `reset_timeout` seconds a single trial call is
+    let through - if it succeeds the circuit closes again, otherwise it stays open for another
+    `reset_timeout` seconds.
+
+    Calls fail if they raise an exception, or if `is_failure` returns True for their result.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def call(self, func, *args, **kwargs):
+        trial = False
+        if self.is_open:
+            if self.trial_in_progress or \
+                    time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'Circuit {self.name} is open.')
+
+            trial = self.trial_in_progress = True
+
+        try:
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                self.record_failure()
+                raise
+
+            if self.is_failure is not None and self.is_failure(result):
+                self.record_failure()
+            else:
+                self.record_success()
+
+            return result
+
+        finally:
+            if trial:
+                self.trial_in_progress = False
+
+    def record_success(self):
+        if self.is_open:
+            log.info('Circuit %(name)s closed.', {'name': self.name})
+
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+
+        if self.is_open:
+            # A failed trial - stay open for another reset timeout.
+            self.opened_at = time.monotonic()
+
+        elif self.failures >= self.failure_threshold:
+            log.warning('Circuit %(name)s opened after %(failures)s consecutive failures.',
+                        {'name': self.name, 'failures': self.failures})
+            self.opened_at = time.monotonic()
@@ -1,13 +1,147 @@
 import logging
+import os
+import random
+import sys
+import time
+
+from collections import deque
+from fnmatch import fnmatchcase
+from gevent.monkey import get_original
 from jog import JogFormatter
 from time import perf_counter
 
-REQUEST_LOG_FORMAT = '%(remote_address)s %(request_protocol)s %(request_method)s %(request_path)s %(status_code)d %(elapsed_time)dms %(content_length)dB'
+from utils.metrics import Counter
+from utils.pool import start_query_stats, stop_query_stats
+
+# Real OS thread functions, even when gevent has monkey patched them.
+start_new_thread = get_original('_thread', 'start_new_thread')
+real_sleep = get_original('time', 'sleep')
+
+LOG_RECORDS_DROPPED = Counter('shh_log_records_dropped_total',
+                              'Number of log records dropped because the log queue was full.')
+
+REQUEST_LOG_FORMAT = '%(remote_address)s %(request_protocol)s %(request_method)s %(request_path)s %(status_code)d %(elapsed_time)dms %(content_length)dB db:%(db_queries)dq wait:%(db_wait_ms).1fms exec:%(db_exec_ms).1fms'
 REQUEST_ERROR_LOG_FORMAT = '%(remote_address)s %(request_protocol)s %(request_method)s %(request_path)s'
 
 
-def wsgi_log_middleware(application, request_logger=None):
-    """WSGI middleware to provide structured logging for requests."""
+class CountingIterable(object):
+    """
+    Wraps a WSGI response iterable, counting the bytes the server sends from it.
+
+    `on_close` is called with the byte count once the server has closed it, i.e. the response has
+    been sent.
+    """
+
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+        self.byte_count = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.byte_count += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.on_close(self.byte_count)
+
+
+def is_file_wrapper(environ, retval):
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    return isinstance(file_wrapper, type) and isinstance(retval, file_wrapper)
+
+
+class RequestLogSampler(object):
+    """
+    Decides which requests to log, to reduce the cost of logging frequent, uninteresting requests.
+
+    `rules` are (path pattern, sample rate) pairs. Successful (2xx) requests whose path matches a
+    pattern are logged at the rate of the first matching rule - all others are always logged, as
+    are requests that took at least `slow_ms` milliseconds.
+
+    At most `rate_limit` requests are logged each second, if set. A summary of how many were
+    suppressed is logged when the next second starts.
+    """
+
+    def __init__(self, request_logger, rules=(), slow_ms=None, rate_limit=None):
+        self.request_logger = request_logger
+        self.rules = tuple(rules)
+        self.slow_ms = slow_ms
+        self.rate_limit = rate_limit
+
+        self.window = None
+        self.window_count = 0
+        self.suppressed = 0
+
+    def sample_rate(self, log_vals):
+        if not 200 <= log_vals['status_code'] < 300:
+            return 1
+        if self.slow_ms is not None and log_vals['elapsed_time'] >= self.slow_ms:
+            return 1
+
+        path = log_vals['request_path'] or ''
+        for pattern, rate in self.rules:
+            if fnmatchcase(path, pattern):
+                return rate
+
+        return 1
+
+    def within_rate_limit(self):
+        if not self.rate_limit:
+            return True
+
+        window = int(time.monotonic())
+        if window != self.window:
+            if self.suppressed:
+                self.request_logger.warning('Suppressed %(suppressed)s request logs over the rate '
+                                            'limit of %(rate_limit)s per second.',
+                                            {'suppressed': self.suppressed,
+                                             'rate_limit': self.rate_limit})
+            self.window = window
+            self.window_count = 0
+            self.suppressed = 0
+
+        if self.window_count >= self.rate_limit:
+            self.suppressed += 1
+            return False
+
+        self.window_count += 1
+        return True
+
+    def should_log(self, log_vals):
+        sample_rate = self.sample_rate(log_vals)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return False
+
+        log_vals['sample_rate'] = sample_rate
+        return self.within_rate_limit()
+
+
+def parse_sample_rule(rule):
+    """Parse a `<path pattern>=<sample rate>` request log sampling rule."""
+    pattern, sep, rate = rule.rpartition('=')
+    if not sep or not pattern:
+        raise ValueError('Sample rules must be of the form <path pattern>=<sample rate>')
+
+    rate = float(rate)
+    if not 0 <= rate <= 1:
+        raise ValueError('Sample rates must be between 0 and 1')
+
+    return pattern, rate
+
+
+def wsgi_log_middleware(application, request_logger=None, sampler=None):
+    """
+    WSGI middleware to provide structured logging for requests.
+
+    Requests are logged once their response has been sent, so the elapsed time and content length
+    cover streaming the response body too. If a RequestLogSampler is provided, only the requests
+    it selects are logged.
+    """
 
     if request_logger is None:
         request_logger = logging.getLogger('wsgi_request')
@@ -15,6 +149,7 @@ def wsgi_log_middleware(application, request_logger=None):
 
     def wsgi_log_wrapper(environ, start_response):
         start = perf_counter()
+        query_stats = start_query_stats()
 
         log_vals = {
             'remote_address': environ.get('REMOTE_ADDR'),
@@ -25,6 +160,8 @@ def wsgi_log_middleware(application, request_logger=None):
 
         status_codes = []
         content_lengths = []
+        # Bytes written via the write() function returned by start_response()
+        written_bytes = 0
 
         # Wrap start_response to enable extracting the status code,
         # content-length header, and exc_info
@@ -32,7 +169,7 @@ def wsgi_log_middleware(application, request_logger=None):
             # Call the actual start_response first, as it may error if it has
             # been called incorrectly. We only want to store values from
             # successful calls.
-            retval = start_response(status, response_headers, exc_info)
+            write = start_response(status, response_headers, exc_info)
 
             status_codes.append(int(status.partition(' ')[0]))
             for name, value in response_headers:
@@ -50,29 +187,169 @@ def wsgi_log_middleware(application, request_logger=None):
                 finally:
                     exc_info = None
 
-            return retval
+            def counting_write(data):
+                nonlocal written_bytes
+                written_bytes += len(data)
+                return write(data)
 
-        retval = application(environ, custom_start_response)
+            return counting_write
 
-        # NOTE: This won't include data written via the write() function
-        #       returned by start_response() if no `content-length` header
-        #       was provided.
-        content_length = content_lengths[-1] if content_lengths else len(b''.join(retval))
+        def log_request(content_length):
+            stop_query_stats()
 
-        log_vals.update({
-            'status_code': status_codes[-1],
-            'elapsed_time': int((perf_counter() - start) * 1000),
-            'content_length': content_length,
-        })
-        request_logger.info(REQUEST_LOG_FORMAT, log_vals)
+            log_vals.update({
+                'status_code': status_codes[-1] if status_codes else 500,
+                'elapsed_time': int((perf_counter() - start) * 1000),
+                'content_length': content_length,
+                'db_queries': query_stats.queries,
+                'db_wait_ms': round(query_stats.wait_time * 1000, 1),
+                'db_exec_ms': round(query_stats.exec_time * 1000, 1),
+            })
+            if sampler is None or sampler.should_log(log_vals):
+                request_logger.info(REQUEST_LOG_FORMAT, log_vals)
 
-        return retval
+        try:
+            retval = application(environ, custom_start_response)
+        except BaseException:
+            stop_query_stats()
+            raise
+
+        # Pass file wrappers through untouched, so the server can still send them efficiently, e.g.
+        # with sendfile(). We can't see the body being sent, so log now, trusting the
+        # content-length header.
+        if is_file_wrapper(environ, retval):
+            log_request(content_lengths[-1] if content_lengths else 0)
+            return retval
+
+        return CountingIterable(retval,
+                                lambda byte_count: log_request(written_bytes + byte_count))
 
     return wsgi_log_wrapper
 
 
-def configure_logging(json=False, verbose=False):
-    log_handler = logging.StreamHandler()
+class AsyncStreamHandler(logging.Handler):
+    """
+    Log handler that formats and writes records to a stream in a background OS thread.
+
+    Logging calls only append the record to a queue, so a slow stream never blocks the gevent hub.
+    The queue holds at most `max_queue` records. When it's full, new records are dropped (and
+    counted) if `overflow` is 'drop', or the caller blocks until there's space if it's 'block'.
+
+    The writer thread doesn't survive forking, so is restarted in child processes.
+    """
+
+    def __init__(self, stream=None, max_queue=10000, overflow='drop', batch_size=100,
+                 poll_interval=0.05):
+        super(AsyncStreamHandler, self).__init__()
+        assert overflow in ('drop', 'block')
+
+        self.stream = stream if stream is not None else sys.stderr
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+        # deque appends and pops are atomic, so the queue can be shared with the writer thread
+        # without a lock - gevent's locks can't be used across OS threads.
+        self.records = deque()
+        self.writing = False
+        # Only ever increased by the emitting thread. The writer thread tracks how many of these
+        # it's reported, so neither thread needs to reset a count the other may be updating.
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.running = False
+
+        self.start()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        # The parent process's writer thread will write any records already queued.
+        self.records.clear()
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.start()
+
+    def start(self):
+        self.running = True
+        self.writing = False
+        start_new_thread(self.run, ())
+
+    def emit(self, record):
+        if len(self.records) >= self.max_queue:
+            if self.overflow == 'drop':
+                self.dropped += 1
+                LOG_RECORDS_DROPPED.inc()
+                return
+
+            # Deliberately block the whole process, rather than just this greenlet, so logging
+            # applies back pressure rather than letting other greenlets fill the queue.
+            while len(self.records) >= self.max_queue and self.running:
+                real_sleep(self.poll_interval)
+
+        self.records.append(record)
+
+    def write_batch(self):
+        lines = []
+        while len(lines) < self.batch_size:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+
+        dropped = self.dropped - self.reported_dropped
+        if dropped:
+            self.reported_dropped += dropped
+            record = logging.makeLogRecord({'name': __name__,
+                                            'levelno': logging.WARNING,
+                                            'levelname': 'WARNING',
+                                            'msg': 'Dropped %(dropped)s log records as the log '
+                                                   'queue was full.',
+                                            'args': {'dropped': dropped}})
+            lines.append(self.format(record))
+
+        if lines:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+
+        return len(lines)
+
+    def run(self):
+        while self.running or self.records:
+            self.writing = True
+            try:
+                written = self.write_batch()
+            except Exception:
+                written = 0
+            finally:
+                self.writing = False
+
+            if not written:
+                real_sleep(self.poll_interval)
+
+    def flush(self, timeout=5):
+        """Wait up to `timeout` seconds for queued records to be written."""
+        waited = 0
+        while (self.records or self.writing) and waited < timeout:
+            real_sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    def close(self):
+        self.flush()
+        self.running = False
+        super(AsyncStreamHandler, self).close()
+
+
+def configure_logging(json=False, verbose=False,
+                      async_logging=False, log_queue_size=10000, log_overflow='drop'):
+    if async_logging:
+        log_handler = AsyncStreamHandler(max_queue=log_queue_size, overflow=log_overflow)
+    else:
+        log_handler = logging.StreamHandler()
     log_format = '[%(asctime)s] %(name)s.%(levelname)s %(threadName)s %(module)s.%(funcName)s %(filename)s:%(lineno)s %(message)s'
     formatter = JogFormatter(log_format) if json else logging.Formatter(log_format)
     log_handler.setFormatter(formatter)
@@ -0,0 +1,445 @@
+import fcntl
+import glob
+import json
+import logging
+import math
+import os
+import socket
+import time
+
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Where the counters and histograms of retired (stale) snapshots in a snapshot directory are kept.
+RETIRED_SNAPSHOT_NAME = 'retired.json'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(v):
+        return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    label_stmts = ','.join(f'{k}="{escape(v)}"' for k, v in labels)
+    return f'{{{label_stmts}}}'
+
+
+def render_families(families):
+    """Render (name, documentation, type, samples) metric families in the Prometheus text format."""
+    lines = []
+    for name, documentation, metric_type, samples in families:
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for suffix, labels, value in samples:
+            lines.append(f'{name}{suffix}{format_labels(labels)} {format_value(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot_path(snapshot_dir, name):
+    """A snapshot path unique to this process, even when the directory is shared between hosts."""
+    return os.path.join(snapshot_dir, f'{name}-{socket.gethostname()}-{os.getpid()}.json')
+
+
+def write_atomically(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    with NamedTemporaryFile('w', dir=directory, prefix='.metrics-', delete=False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+
+
+@contextmanager
+def locked(directory):
+    """Hold an exclusive lock on a snapshot directory, shared by all the processes using it."""
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def sample_key(suffix, labels):
+    return suffix, tuple(tuple(label) for label in labels)
+
+
+def merge_samples(families, name, documentation, metric_type, samples):
+    """Add samples to those in a name -> (documentation, type, {sample key: value}) dict."""
+    if name not in families:
+        families[name] = (documentation, metric_type, OrderedDict())
+    merged_samples = families[name][2]
+    for suffix, labels, value in samples:
+        key = sample_key(suffix, labels)
+        merged_samples[key] = merged_samples.get(key, 0) + value
+
+
+def is_stale(snapshot, now):
+    return now - snapshot['written_at'] > snapshot['stale_after']
+
+
+def retire_snapshots(retired, snapshots, now):
+    """
+    Fold the counters and histograms of snapshots into a retired snapshot, returning it.
+
+    Gauges are dropped, as they're only meaningful while the process that wrote them is running.
+    """
+    families = OrderedDict()
+    for snapshot in [retired, *snapshots]:
+        for metric in snapshot['metrics']:
+            if metric['type'] != 'gauge':
+                merge_samples(families, metric['name'], metric['documentation'], metric['type'],
+                              metric['samples'])
+
+    return {
+        'written_at': now,
+        'stale_after': None,
+        'metrics': [{'name': name,
+                     'documentation': documentation,
+                     'type': metric_type,
+                     'samples': [(suffix, labels, value)
+                                 for (suffix, labels), value in samples.items()]}
+                    for name, (documentation, metric_type, samples) in families.items()],
+    }
+
+
+class Registry(object):
+    """A collection of metrics that can be rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+        # Where this process last wrote a snapshot, if anywhere.
+        self.snapshot_path = None
+        # Counter and histogram totals as of the last snapshot, and the totals already accounted
+        # for by retired snapshots, by (metric name, sample key).
+        self.snapshot_totals = {}
+        self.retired_totals = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """Yield (metric, samples) pairs, where samples are (suffix, labels, value) tuples."""
+        for metric in self.metrics:
+            yield metric, list(metric.samples())
+
+    def render(self):
+        return render_families((metric.name, metric.documentation, metric.type, samples)
+                               for metric, samples in self.collect())
+
+    def write_textfile(self, path):
+        """
+        Write the rendered metrics to a file, e.g. for the node exporter textfile collector.
+
+        The file is replaced atomically, so readers never see a partially written file.
+        """
+        write_atomically(path, self.render())
+
+    def write_snapshot(self, path, stale_after):
+        """
+        Write the current metric values to a JSON file, for rendering by another process.
+
+        Once the snapshot is more than `stale_after` seconds old, the process that wrote it is
+        assumed to have exited. Its gauges are ignored, and its counters and histograms are folded
+        into the directory's retired snapshot, so totals don't go backwards, before it's deleted.
+
+        If that happens while this process is still running (e.g. it was stalled), only the
+        increase since the retired snapshot is written from then on, so nothing is counted twice.
+        """
+        path = os.path.abspath(path)
+        with locked(os.path.dirname(path)):
+            if path == self.snapshot_path and not os.path.exists(path):
+                log.warning('Metrics snapshot %(path)s was retired while this process was running.',
+                            {'path': path})
+                self.retired_totals = self.snapshot_totals
+
+            totals = {}
+            metrics = []
+            for metric, samples in self.collect():
+                if metric.type != 'gauge':
+                    for suffix, labels, value in samples:
+                        totals[(metric.name, sample_key(suffix, labels))] = value
+                    samples = [(suffix, labels,
+                                value - self.retired_totals.get(
+                                    (metric.name, sample_key(suffix, labels)), 0))
+                               for suffix, labels, value in samples]
+
+                metrics.append({'name': metric.name,
+                                'documentation': metric.documentation,
+                                'type': metric.type,
+                                'samples': samples})
+
+            snapshot = {
+                'written_at': time.time(),
+                'stale_after': stale_after,
+                'metrics': metrics,
+            }
+            write_atomically(path, json.dumps(snapshot))
+            self.snapshot_path = path
+            self.snapshot_totals = totals
+
+    def read_snapshots(self, snapshot_dir):
+        """
+        Read the snapshots in a directory, other than this process's own, retiring stale ones.
+
+        Retiring snapshots relies on file locks, so the directory should be on a local filesystem.
+        """
+        snapshot_dir = os.path.abspath(snapshot_dir)
+        retired_path = os.path.join(snapshot_dir, RETIRED_SNAPSHOT_NAME)
+        now = time.time()
+
+        with locked(snapshot_dir):
+            snapshots = OrderedDict()
+            for path in sorted(glob.glob(os.path.join(snapshot_dir, '*.json'))):
+                if path == self.snapshot_path:
+                    continue
+
+                try:
+                    with open(path) as f:
+                        snapshots[path] = json.load(f)
+                except (OSError, ValueError):
+                    log.warning('Failed to read metrics snapshot %(path)s.', {'path': path},
+                                exc_info=True)
+
+            retired = snapshots.pop(retired_path, None)
+            stale_paths = [path for path, snapshot in snapshots.items() if is_stale(snapshot, now)]
+            # Don't replace a retired snapshot that couldn't be read, losing its totals.
+            if stale_paths and (retired is not None or not os.path.exists(retired_path)):
+                retired = retire_snapshots(retired or {'metrics': []},
+                                           [snapshots.pop(path) for path in stale_paths],
+                                           now)
+                write_atomically(retired_path, json.dumps(retired))
+                for path in stale_paths:
+                    os.remove(path)
+                log.info('Retired %(count)s stale metrics snapshots.', {'count': len(stale_paths)})
+
+        if retired is not None:
+            snapshots[retired_path] = retired
+        return list(snapshots.values())
+
+    def render_merged(self, snapshot_dir):
+        """
+        Render the metrics of this process combined with those in the snapshots in a directory.
+
+        Samples with the same name and labels are summed across processes. This process's own
+        snapshot, if any, is skipped in favour of its live values.
+        """
+        families = OrderedDict()
+
+        for metric, samples in self.collect():
+            merge_samples(families, metric.name, metric.documentation, metric.type, samples)
+
+        for snapshot in self.read_snapshots(snapshot_dir):
+            for metric in snapshot['metrics']:
+                merge_samples(families, metric['name'], metric['documentation'], metric['type'],
+                              metric['samples'])
+
+        return render_families((name, documentation, metric_type,
+                                [(suffix, labels, value)
+                                 for (suffix, labels), value in samples.items()])
+                               for name, (documentation, metric_type, samples) in families.items())
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """
+    Base class for metrics.
+
+    Each distinct set of label values gets its own child, which holds the actual value. Values are
+    updated without locks - this is safe as long as updates only happen from greenlets (or a single
+    thread), which never switch in the middle of an update.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues):
+        assert len(labelvalues) == len(self.labelnames)
+
+        child = self.children.get(labelvalues)
+        if child is None:
+            child = self.children[labelvalues] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def child_samples(self, child):
+        raise NotImplementedError
+
+    def samples(self):
+        for labelvalues, child in list(self.children.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            for suffix, extra_labels, value in self.child_samples(child):
+                yield suffix, labels + extra_labels, value
+
+
+class CounterChild(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        assert amount >= 0
+        self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def child_samples(self, child):
+        # NOTE: Following the Prometheus text format, counter names should end in `_total`.
+        yield '', [], child.value
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeChild(object):
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Report the result of calling `function` whenever the gauge is collected."""
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+    def child_samples(self, child):
+        yield '', [], child.function() if child.function is not None else child.value
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class HistogramChild(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Per bucket (non-cumulative) counts. The last entry is the +Inf bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.sum += value
+        # Index of the first bucket with an upper bound >= value, or the +Inf bucket.
+        self.counts[bisect_left(self.buckets, value)] += 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY,
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation,
+                                        labelnames=labelnames, registry=registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def child_samples(self, child):
+        cumulative_count = 0
+        for bound, count in zip((*self.buckets, math.inf), child.counts):
+            cumulative_count += count
+            yield '_bucket', [('le', format_value(float(bound)))], cumulative_count
+        yield '_count', [], cumulative_count
+        yield '_sum', [], child.sum
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+HTTP_REQUEST_SECONDS = Histogram('shh_http_request_duration_seconds',
+                                 'How long requests took to handle, by route.',
+                                 labelnames=('method', 'route'))
+HTTP_REQUESTS = Counter('shh_http_requests_total',
+                        'Number of requests handled, by route and status code.',
+                        labelnames=('method', 'route', 'status'))
+
+
+def wsgi_metrics_middleware(application):
+    """
+    WSGI middleware to record request counts and latencies.
+
+    Requests are labelled with the rule and method of the bottle route that handled them, rather
+    than their path and method, to keep the number of label values bounded - clients can send any
+    path or method. Requests no route matched are all labelled `unmatched` and `other`.
+    """
+
+    def wsgi_metrics_wrapper(environ, start_response):
+        start = perf_counter()
+        statuses = []
+
+        def custom_start_response(status, response_headers, exc_info=None):
+            retval = start_response(status, response_headers, exc_info)
+            statuses.append(status.partition(' ')[0])
+            return retval
+
+        try:
+            return application(environ, custom_start_response)
+
+        finally:
+            route = environ.get('bottle.route')
+            if route is not None:
+                route_rule, method = route.rule, route.method
+            else:
+                route_rule, method = 'unmatched', 'other'
+            HTTP_REQUEST_SECONDS.labels(method, route_rule).observe(perf_counter() - start)
+            HTTP_REQUESTS.labels(method, route_rule, statuses[-1] if statuses else '500').inc()
+
+    return wsgi_metrics_wrapper
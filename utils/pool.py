@@ -0,0 +1,320 @@
+import functools
+import logging
+import time
+
+from bottle import HTTPError
+from collections import deque
+from gevent.local import local
+from gevent.lock import Semaphore
+from pymysql.constants import SERVER_STATUS
+from time import perf_counter
+
+from utils.metrics import Counter, Gauge, Histogram
+
+log = logging.getLogger(__name__)
+
+POOL_CHECKOUTS = Counter('shh_db_pool_checkouts_total',
+                         'Number of connections checked out of the database connection pool.')
+POOL_WAITS = Counter('shh_db_pool_waits_total',
+                     'Number of checkouts that had to wait for a connection to be returned.')
+POOL_TIMEOUTS = Counter('shh_db_pool_timeouts_total',
+                        'Number of checkouts that timed out waiting for a connection.')
+POOL_WAIT_SECONDS = Histogram('shh_db_pool_wait_seconds',
+                              'How long checkouts waited for a connection.',
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+POOL_CONNECTIONS = Gauge('shh_db_pool_connections',
+                         'Number of open database connections, by state.',
+                         labelnames=('state',))
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class QueryStats(object):
+    """Database time spent handling a request, split into waiting for a connection, and using it."""
+
+    def __init__(self):
+        self.queries = 0
+        self.wait_time = 0
+        self.exec_time = 0
+
+
+# Stats are per greenlet, and so per request.
+query_stats_local = local()
+
+
+def start_query_stats():
+    """Start recording database usage in the current greenlet, returning the stats to update."""
+    stats = query_stats_local.stats = QueryStats()
+    return stats
+
+
+def stop_query_stats():
+    query_stats_local.stats = None
+
+
+def current_query_stats():
+    return getattr(query_stats_local, 'stats', None)
+
+
+class TimedCursor(object):
+    """Wraps a cursor, recording the time spent executing queries and fetching their results."""
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def timed(self, func, *args):
+        start = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.stats.exec_time += perf_counter() - start
+
+    def execute(self, query, args=None):
+        self.stats.queries += 1
+        return self.timed(self.cursor.execute, query, args)
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed(self.cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+    def close(self):
+        # Closing an unbuffered cursor reads any remaining results.
+        self.timed(self.cursor.close)
+
+
+class PooledConnection(object):
+    """
+    A connection checked out of a ConnectionPool.
+
+    Supports the subset of the DB-API connection interface the DAOs use. Closing it returns the
+    underlying connection to the pool, rather than closing it.
+    """
+
+    def __init__(self, pool, entry, stats=None):
+        self.pool = pool
+        self.entry = entry
+        self.stats = stats
+        # Whether the last thing done with the connection was ending the transaction.
+        self.transaction_ended = False
+
+    def cursor(self, *args, **kwargs):
+        self.transaction_ended = False
+        cursor = self.entry.conn.cursor(*args, **kwargs)
+        if self.stats is not None:
+            cursor = TimedCursor(cursor, self.stats)
+        return cursor
+
+    def timed(self, func):
+        if self.stats is None:
+            return func()
+
+        start = perf_counter()
+        try:
+            return func()
+        finally:
+            self.stats.exec_time += perf_counter() - start
+
+    def commit(self):
+        self.transaction_ended = False
+        self.timed(self.entry.conn.commit)
+        self.transaction_ended = True
+
+    def rollback(self):
+        self.transaction_ended = False
+        self.timed(self.entry.conn.rollback)
+        self.transaction_ended = True
+
+    def close(self):
+        # Only return the connection once, even if closed multiple times.
+        if self.entry is not None:
+            entry, self.entry = self.entry, None
+            self.pool.release(entry, self.transaction_ended)
+
+
+class PoolEntry(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.returned_at = self.created_at
+
+
+class ConnectionPool(object):
+    """
+    A pool of database connections, for use from greenlets.
+
+    At most `max_size` connections are open at once. `min_size` connections are opened up front,
+    and up to `max_idle` are kept open between checkouts. Checkouts wait at most `acquire_timeout`
+    seconds for a connection, raising PoolTimeoutError otherwise.
+
+    Connections older than `recycle` seconds are replaced rather than reused, and connections idle
+    for at least `ping_idle` seconds are pinged before being reused, so connections dropped by the
+    server aren't handed out. Set either to None to disable it.
+
+    Open transactions are rolled back when a connection is returned, so never leak between
+    checkouts.
+
+    If query stats have been started in the current greenlet, the time spent checking out
+    connections, and executing queries on them, is added to the stats.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, max_idle=10, acquire_timeout=5,
+                 recycle=3600, ping_idle=30):
+        assert 0 <= min_size <= max_size
+
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max(min(max_idle, max_size), min_size)
+        self.acquire_timeout = acquire_timeout
+        self.recycle = recycle
+        self.ping_idle = ping_idle
+
+        # Each connection, open or yet to be opened, holds one slot of the semaphore while checked out.
+        self.slots = Semaphore(max_size)
+        # Most recently returned last - reusing recently used connections lets the rest go idle
+        # and be closed.
+        self.idle = deque()
+        self.in_use = 0
+
+        for _ in range(min_size):
+            self.idle.append(self.open())
+        self.update_gauges()
+
+    def update_gauges(self):
+        POOL_CONNECTIONS.labels('idle').set(len(self.idle))
+        POOL_CONNECTIONS.labels('in_use').set(self.in_use)
+
+    def open(self):
+        return PoolEntry(self.connect())
+
+    def discard(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            log.debug('Error closing database connection.', exc_info=True)
+
+    def is_usable(self, entry, now):
+        if self.recycle is not None and now - entry.created_at >= self.recycle:
+            return False
+
+        if self.ping_idle is not None and now - entry.returned_at >= self.ping_idle:
+            try:
+                entry.conn.ping(reconnect=False)
+            except Exception:
+                log.info('Discarding broken database connection.')
+                return False
+
+        return True
+
+    def connection(self):
+        stats = current_query_stats()
+        if stats is None:
+            return self.checkout()
+
+        start = perf_counter()
+        try:
+            return self.checkout(stats)
+        finally:
+            stats.wait_time += perf_counter() - start
+
+    def checkout(self, stats=None):
+        POOL_CHECKOUTS.inc()
+
+        if not self.slots.acquire(blocking=False):
+            POOL_WAITS.inc()
+            start = time.monotonic()
+            acquired = self.slots.acquire(timeout=self.acquire_timeout)
+            POOL_WAIT_SECONDS.observe(time.monotonic() - start)
+
+            if not acquired:
+                POOL_TIMEOUTS.inc()
+                raise PoolTimeoutError(f'Timed out after {self.acquire_timeout} seconds waiting '
+                                       f'for a database connection.')
+        else:
+            POOL_WAIT_SECONDS.observe(0)
+
+        try:
+            entry = None
+            now = time.monotonic()
+            while self.idle:
+                candidate = self.idle.pop()
+                if self.is_usable(candidate, now):
+                    entry = candidate
+                    break
+                self.discard(candidate)
+
+            if entry is None:
+                entry = self.open()
+
+        except BaseException:
+            self.slots.release()
+            self.update_gauges()
+            raise
+
+        self.in_use += 1
+        self.update_gauges()
+        return PooledConnection(self, entry, stats)
+
+    def release(self, entry, transaction_ended=False):
+        self.in_use -= 1
+        try:
+            try:
+                # Skip the round trip when the transaction was just committed (or rolled back).
+                # A failed statement may have started a transaction without the server status
+                # being updated, so the status alone can't be trusted.
+                if not transaction_ended or \
+                        entry.conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    entry.conn.rollback()
+            except Exception:
+                log.info('Discarding database connection that failed to roll back.', exc_info=True)
+                self.discard(entry)
+                return
+
+            if len(self.idle) >= self.max_idle:
+                self.discard(entry)
+                return
+
+            entry.returned_at = time.monotonic()
+            self.idle.append(entry)
+
+        finally:
+            self.slots.release()
+            self.update_gauges()
+
+
+class PoolTimeoutPlugin(object):
+    """Bottle plugin to respond 503 when a request times out waiting for a database connection."""
+    name = 'pool_timeout'
+    api = 2
+
+    def __init__(self, retry_after=1):
+        self.retry_after = retry_after
+
+    def apply(self, callback, route=None):
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            except PoolTimeoutError as e:
+                log.warning('Request timed out waiting for a database connection.')
+                raise HTTPError(503, None, e, **{'Retry-After': str(self.retry_after)})
+
+        return wrapper
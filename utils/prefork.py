@@ -0,0 +1,118 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+from utils import nice_shutdown
+
+log = logging.getLogger(__name__)
+
+# Where available, each worker process listens on its own socket bound to the same port, and the
+# kernel balances connections between them. Otherwise the workers share a single listening socket
+# created by the supervisor.
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+def create_listener(host, port, reuse_port=False, backlog=1024):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def exit_status(e):
+    """Convert a SystemExit exception to a process exit status, as the interpreter would."""
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    return 1
+
+
+def run_prefork(serve, workers, host, port, restart_delay=1):
+    """
+    Run `workers` worker processes, each serving requests with `serve(listener)`.
+
+    The calling process becomes a supervisor. It restarts workers that exit unexpectedly, and
+    passes shutdown signals on to the workers as SIGTERM, so each can shut down gracefully. It
+    returns once all the workers have exited.
+
+    `serve` is only called in the worker processes, after forking, so should create any per
+    process resources, e.g. database connection pools, itself.
+    """
+
+    listener = None if REUSE_PORT else create_listener(host, port)
+
+    # Worker pid -> worker number
+    worker_pids = {}
+    shutting_down = False
+
+    def run_worker():
+        # Don't run the supervisor's signal handlers in the worker - `serve` should set up its own.
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+
+        status = 0
+        try:
+            serve(listener or create_listener(host, port, reuse_port=True))
+        except SystemExit as e:
+            status = exit_status(e)
+        except BaseException:
+            log.exception('Worker %(pid)s failed.', {'pid': os.getpid()})
+            status = 1
+        finally:
+            # Never return into the supervisor's code.
+            logging.shutdown()
+            os._exit(status)
+
+    def spawn(worker_num):
+        pid = os.fork()
+        if pid == 0:
+            run_worker()
+
+        worker_pids[pid] = worker_num
+        log.info('Started worker %(worker_num)s with pid %(pid)s.',
+                 {'worker_num': worker_num, 'pid': pid})
+
+    def shutdown():
+        nonlocal shutting_down
+        shutting_down = True
+
+        for pid in list(worker_pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    with nice_shutdown(shutdown):
+        for worker_num in range(workers):
+            spawn(worker_num)
+
+        while worker_pids:
+            pid, status = os.waitpid(-1, 0)
+            worker_num = worker_pids.pop(pid, None)
+            if worker_num is None:
+                continue
+
+            if shutting_down:
+                log.info('Worker %(worker_num)s with pid %(pid)s exited.',
+                         {'worker_num': worker_num, 'pid': pid})
+                continue
+
+            if os.WIFSIGNALED(status):
+                exit_reason = f'signal {signal.Signals(os.WTERMSIG(status)).name}'
+            else:
+                exit_reason = f'status {os.WEXITSTATUS(status)}'
+            log.warning('Worker %(worker_num)s with pid %(pid)s exited unexpectedly with '
+                        '%(exit_reason)s. Restarting.',
+                        {'worker_num': worker_num, 'pid': pid, 'exit_reason': exit_reason})
+            # Avoid spinning if workers are crashing on startup.
+            time.sleep(restart_delay)
+            if not shutting_down:
+                spawn(worker_num)
+
+    log.info('All workers exited.')
@@ -2,7 +2,7 @@ import functools
 import logging
 import re
 
-from bottle import HTTPResponse, response
+from bottle import HeaderDict, HTTPResponse, response
 
 
 PP_ALLOWLIST_REGEX = re.compile(r'^\((.*)\)$')
@@ -11,13 +11,27 @@ PP_ORIGIN_REGEX = re.compile(r'^"(.*)"$')
 log = logging.getLogger(__name__)
 
 
-def ensure_headers(r, headers):
-    """Set headers on a response if not already set"""
+def freeze_headers(headers):
+    """
+    Convert a header dict to a tuple of (name, value) pairs, for `ensure_frozen_headers`.
+
+    Names are normalised and values validated up front, by bottle's HeaderDict, so it's done once
+    rather than for every response.
+    """
+    return tuple(HeaderDict(headers).items())
+
+
+def ensure_frozen_headers(r, frozen_headers):
+    """Set frozen headers on a response if not already set"""
     r = r if isinstance(r, HTTPResponse) else response
 
-    for k, v in headers.items():
-        if k not in r.headers:
-            r.set_header(k, v)
+    r_headers = r.headers
+    # Iterating a HeaderDict gives normalised names, like the frozen ones, so they can be compared
+    # directly, rather than normalising each name again for every lookup.
+    existing = set(r_headers)
+    for k, v in frozen_headers:
+        if k not in existing:
+            r_headers[k] = v
 
 
 def pp_origin_to_fp(origin):
@@ -202,15 +216,15 @@ class SecurityHeadersPlugin(object):
                 pp_updates = {k[prefix_len:]: v for k, v in route.config.items()
                               if k[:prefix_len] == prefix}
 
-        headers = {**self.get_sh(sh_updates=sh_updates),
-                   'Content-Security-Policy': self.get_csp(csp_updates=csp_updates),
-                   'Permissions-Policy': self.get_pp(pp_updates=pp_updates),
-                   'Feature-Policy': self.get_fp(pp_updates=pp_updates)}
+        headers = freeze_headers({**self.get_sh(sh_updates=sh_updates),
+                                  'Content-Security-Policy': self.get_csp(csp_updates=csp_updates),
+                                  'Permissions-Policy': self.get_pp(pp_updates=pp_updates),
+                                  'Feature-Policy': self.get_fp(pp_updates=pp_updates)})
 
         @functools.wraps(callback)
         def wrapper(*args, **kwargs):
             r = callback(*args, **kwargs)
-            ensure_headers(r, headers)
+            ensure_frozen_headers(r, headers)
             return r
 
         return wrapper
@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from bottle import HTTPError, HTTPResponse, request
+
+from utils.compression import COMPRESSIBLE_TYPES, accepted_encodings
+from utils.security_headers import ensure_frozen_headers, freeze_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+HASH_LENGTH = 12
+IMMUTABLE_CACHE_HEADERS = freeze_headers({'Cache-Control': 'public, max-age=31536000, immutable'})
+# Unhashed URLs can change content at any time, so must be revalidated - cheaply, thanks to ETags.
+MUTABLE_CACHE_HEADERS = freeze_headers({'Cache-Control': 'no-cache'})
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+
+class AssetVariant(object):
+
+    def __init__(self, body, etag, headers):
+        self.body = body
+        self.etag = etag
+        self.headers = headers
+
+
+class Asset(object):
+    """A static file, and its compressed variants, held in memory."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.digest = hashlib.blake2b(data).hexdigest()[:HASH_LENGTH]
+
+        stem, ext = os.path.splitext(name)
+        self.hashed_name = f'{stem}.{self.digest}{ext}'
+
+        content_type, _ = mimetypes.guess_type(name)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type.endswith(('javascript', 'json')):
+            content_type += '; charset=UTF-8'
+
+        encoded = {}
+        if content_type.startswith(COMPRESSIBLE_TYPES):
+            if brotli is not None:
+                encoded['br'] = brotli.compress(data)
+            encoded['gzip'] = gzip.compress(data, mtime=0)
+        # Only keep variants that are actually smaller.
+        encoded = {encoding: body for encoding, body in encoded.items() if len(body) < len(data)}
+
+        self.etags = set()
+        self.variants = {}
+        for encoding, body in [(None, data), *encoded.items()]:
+            etag = f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+            self.etags.add(etag)
+
+            headers = {'Content-Type': content_type, 'ETag': etag}
+            if encoding:
+                headers['Content-Encoding'] = encoding
+            if encoded:
+                headers['Vary'] = 'Accept-Encoding'
+            self.variants[encoding] = AssetVariant(body, etag, freeze_headers(headers))
+
+    def choose_variant(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding, ('br', 'gzip'))
+
+        # Prefer the smallest encoding the client accepts.
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and encoding in accepted:
+                return self.variants[encoding]
+
+        return self.variants[None]
+
+
+class StaticAssets(object):
+    """
+    Serves the files in a directory from memory.
+
+    All files are loaded, hashed, and compressed on startup. Each file can be requested by its
+    name, or by a content hashed name, e.g. `main.<hash>.css`. Hashed names change whenever the
+    file does, so are served with immutable caching - link to them with `url()`.
+    """
+
+    def __init__(self, root):
+        self.assets = {}
+        self.urls = {}
+
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if not os.path.isfile(path):
+                continue
+
+            with open(path, 'rb') as f:
+                asset = Asset(name, f.read())
+
+            self.assets[name] = (asset, MUTABLE_CACHE_HEADERS)
+            self.assets[asset.hashed_name] = (asset, IMMUTABLE_CACHE_HEADERS)
+            self.urls[name] = f'/{asset.hashed_name}'
+
+        log.info('Loaded %(count)s static assets.', {'count': len(self.urls)})
+
+    def url(self, name):
+        """The content hashed URL of an asset."""
+        return self.urls.get(name, f'/{name}')
+
+    def serve(self, name):
+        entry = self.assets.get(name)
+        if entry is None:
+            return HTTPError(404, 'File does not exist.')
+        asset, cache_headers = entry
+
+        variant = asset.choose_variant(request.headers.get('Accept-Encoding', ''))
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # Compare weakly, as intermediaries may weaken the ETags of responses they compress.
+            etags = {etag.strip().replace('W/', '', 1) for etag in if_none_match.split(',')}
+            # Any variant matching means the client has the current content.
+            if '*' in etags or etags & asset.etags:
+                r = HTTPResponse(status=304)
+                ensure_frozen_headers(r, variant.headers)
+                ensure_frozen_headers(r, cache_headers)
+                return r
+
+        r = HTTPResponse(variant.body)
+        ensure_frozen_headers(r, variant.headers)
+        ensure_frozen_headers(r, cache_headers)
+        return r
@@ -11,16 +11,18 @@
 
     <link rel="stylesheet" type="text/css" href="https://necolas.github.io/normalize.css/8.0.1/normalize.css" crossorigin>
     <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@400;500&family=Roboto+Slab:wght@500&display=swap" rel="stylesheet" crossorigin>
-    <link rel="stylesheet" type="text/css" href="/main.css">
+    <link rel="stylesheet" type="text/css" href="{{asset_url('main.css')}}">
 
     <meta name="theme-color" content="#0078E7">
-    <link rel="apple-touch-icon" sizes="180x180" href="/apple-touch-icon.png">
-    <link rel="icon" type="image/png" sizes="32x32" href="/favicon-32x32.png">
-    <link rel="icon" type="image/png" sizes="16x16" href="/favicon-16x16.png">
+    <link rel="apple-touch-icon" sizes="180x180" href="{{asset_url('apple-touch-icon.png')}}">
+    <link rel="icon" type="image/png" sizes="32x32" href="{{asset_url('favicon-32x32.png')}}">
+    <link rel="icon" type="image/png" sizes="16x16" href="{{asset_url('favicon-16x16.png')}}">
     <link rel="manifest" href="/site.webmanifest">
   </head>
   <body>
-% if get('do_indent', True):
+% if get('pre_indented', False):
+{{!base}}\\
+% elif get('do_indent', True):
 %   from shh.misc import indent
 {{!indent(base, 4)}}
 % else:
@@ -29,7 +31,7 @@
 
     % if defined('post_scripts'):
     %   for script in post_scripts:
-    <script src="/{{script}}.js"></script>
+    <script src="{{asset_url(script + '.js')}}"></script>
     %   end
     % end
   </body>
@@ -4,8 +4,8 @@
   <div class="content">
     <h1>shh!</h1>
     <div class="section">
-      % if error.body and error.status_code < 500:
-      <p>{{error.body}}</p>
+      % if message:
+      <p>{{message}}</p>
       % else:
       <p>Oops, something went wrong</p>
       % end
@@ -3,8 +3,8 @@
   <span class="spacer"></span>
   <div class="content">
     <h1>shh!</h1>
-    % if error.body and not error.body.startswith('Not found: '):
-    <p>{{error.body}}</p>
+    % if message:
+    <p>{{message}}</p>
     % else:
     <p>Oops, that page doesn't exist</p>
     % end
@@ -22,6 +22,11 @@
         </p>
       </div>
       %   end
+      %   if defined('next_cursor') and next_cursor:
+      <div class="linkRow">
+        <a href="/secrets?after={{next_cursor}}">More secrets</a>
+      </div>
+      %   end
       % else:
       <p>No active secrets</p>
       % end